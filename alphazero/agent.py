@@ -3,14 +3,23 @@ import sys
 sys.path.append(os.path.join(os.environ["HOME"], "TTTArena"))
 
 from agent import Agent
+from environment import Environment
 
 from alphazero.mcts import MCTS
 from alphazero.model import ZeroTTT
+from alphazero.parallel import ParallelMCTS
+from alphazero.threats import ThreatSolver
+from alphazero.profiling import get_profiler
 
 default_model_args = {
   "board_len": 10,
   "lr": 3e-4,
-  "weight_decay": 1e-4
+  "weight_decay": 1e-4,
+  "compile": False,
+  "quantize": False,
+  "calibration_path": None,
+  "bf16": False,
+  "channels_last": False
 }
 
 default_mcts_args = {
@@ -18,7 +27,9 @@ default_mcts_args = {
   "alpha": 0.01,
   "c_puct": 4,
   "dirichlet_alpha": 0.3,
-  "tau": 0.01
+  "tau": 0.01,
+  "num_workers": 1,
+  "vcf_budget": 0
 }
 
 class ZeroAgent(Agent):
@@ -27,23 +38,82 @@ class ZeroAgent(Agent):
     self.model = ZeroTTT(model_name, opt_state_name, args["model_args"])
     self.model.brain.eval()
     self.args = args
+    self.mcts = None
+
+    # Tactically decided moves (wins and forced blocks) are played without searching
+    budget = args["mcts_args"].get("vcf_budget", 0)
+    self.solver = ThreatSolver(args["model_args"]["board_len"], budget) if budget else None
+
+    # Opt-in with ALPHAZERO_PROFILE, per move latency inside make_action, written out when a game ends
+    self.profiler = get_profiler(args.get("profile"))
+    self.games_played = 0
+    if self.profiler is not None:
+      self.choose_move = self.profiler.wrap_move(self.choose_move, "ZeroAgent.make_action")
 
   def reset(self, state):
-    self.mcts = MCTS(self.model, state, self.args["mcts_args"])
+    self.end_game() # a previous game that was abandoned before it ended
+    self.games_played += 1
+
+    if isinstance(self.mcts, ParallelMCTS):
+      self.mcts.close()
+    if self.args["mcts_args"].get("num_workers", 1) > 1: # root-parallel search over multiple cores
+      self.mcts = ParallelMCTS(self.model, state, self.args["mcts_args"])
+    else:
+      self.mcts = MCTS(self.model, state, self.args["mcts_args"])
+
+  def end_game(self):
+    # Writes the profile of the current game, does nothing if it has no profiled moves (or was already written)
+    if self.profiler is not None:
+      self.profiler.dump(f"{self.name}_game_{self.games_played}")
+
+  def check_game_over(self):
+    # Only needed for the profile, so the board isn't checked otherwise. Runs outside the profiled move, so it calls
+    # the unwrapped game_over to keep it out of the profile
+    if self.profiler is None:
+      return
+    game_over = getattr(Environment.game_over, "__wrapped__", Environment.game_over)
+    if game_over(self.mcts.root) != 10:
+      self.end_game()
+
+  def close(self):
+    self.end_game()
+    if isinstance(self.mcts, ParallelMCTS):
+      self.mcts.close()
 
   def make_action(self, state):
+    move = self.choose_move(state)
+    self.check_game_over()
+    return move
+
+  def choose_move(self, state):
+    if self.solver is not None:
+      _, move = self.solver.solve(self.mcts.root)
+      if move is not None:
+        self.mcts.select_move(external_move=move)
+        return move
+
     self.mcts.search()
     move = self.mcts.select_move(tau=self.args["mcts_args"]["tau"])
     return move
 
   def update_state(self, action):
     self.mcts.select_move(external_move=action)
+    self.check_game_over()
 
   @staticmethod
   def get_params():
     model_name = input("Model name: ")
     opt_state_name = input("Optimizer state name: ")
 
+    if input("Would you like to use the int8 quantized model? ") != "":
+      default_model_args["quantize"] = True
+      calibration_path = input("Replay buffer to calibrate on (empty for random positions): ")
+      if calibration_path != "":
+        default_model_args["calibration_path"] = calibration_path
+    elif input("Would you like to use bf16 inference? ") != "":
+      default_model_args["bf16"] = True
+      default_model_args["channels_last"] = True
+
     if input("Would you like to adjust MCTS args? ") != "":
       for key in default_mcts_args:
         inp = input(f"{key}: ")
@@ -1,7 +1,16 @@
 import os
+import json
+import time
+import fcntl
+import queue
+import threading
 import numpy as np
 from copy import deepcopy
 from collections import deque
+from contextlib import contextmanager
+
+import torch
+from torch.utils.data import Dataset
 
 def prepare_state(state):
   split = np.zeros((2, len(state), len(state)))
@@ -13,6 +22,17 @@ def prepare_state(state):
         split[1][i][j] = 1
   return split
 
+def prepare_state_into(state, out):
+  # Vectorized prepare_state writing into a preallocated 2 x board_len x board_len buffer (e.g. a predict_batch row)
+  np.equal(state, 1, out=out[0], casting="unsafe")
+  np.equal(state, -1, out=out[1], casting="unsafe")
+  return out
+
+def prepare_states(states):
+  # Vectorized prepare_state of a sequence of states
+  states = np.asarray(states)
+  return np.stack([states == 1, states == -1], axis=1).astype(np.float64)
+
 def unprepare_state(prepared_state):
   board_len = len(prepared_state[0])
   state = np.zeros((board_len, board_len))
@@ -44,6 +64,68 @@ def swap_perspective_augmentation(states, labels):
     val_mask += [1, -1]
   return aug_states, aug_labels, val_mask
 
+def deduplicate(states, policy_labels, value_labels, counts=None):
+  '''
+    Merges repeated positions, keyed by the board with -0.0 and 0.0 treated alike, into one position with
+    the average of their policy and value targets
+
+    counts - (optional) # of positions already merged into each position (its weight in the average), default 1
+
+    returns unique states, policy labels, value labels and the # of positions merged into each
+  '''
+  boards = np.asarray(states)
+  counts = np.ones(len(boards)) if counts is None else np.asarray(counts, dtype=float)
+  keys = boards.reshape(len(boards), -1).astype(np.int8)
+  _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+  inverse = inverse.reshape(-1)
+
+  policies = np.zeros((len(first),) + np.shape(policy_labels[0]))
+  values = np.zeros(len(first))
+  merged_counts = np.zeros(len(first))
+  np.add.at(policies, inverse, counts[:, None] * np.asarray(policy_labels))
+  np.add.at(values, inverse, counts * np.asarray(value_labels))
+  np.add.at(merged_counts, inverse, counts)
+
+  return boards[first] + 0.0, policies / merged_counts[:, None], values / merged_counts, merged_counts
+
+def symmetry(boards, k):
+  # k-th of the 8 symmetries of the square (rotation by k % 4 quarter turns, transposed if k >= 4) of a batch of boards
+  boards = np.rot90(boards, k % 4, axes=(1, 2))
+  return boards.transpose(0, 2, 1) if k >= 4 else boards
+
+class ReplayDataset(Dataset):
+  def __init__(self, states, policy_labels, value_labels, augment=True):
+    '''
+      Positions of a DataBase for a torch DataLoader, indexed by whole batches (use a BatchSampler as the sampler and
+      batch_size=None) so preparing the states and augmenting is vectorized over the batch
+
+      states - N x board_len x board_len boards
+      policy_labels - N x board_len*board_len policies
+      augment - apply a random one of the 8 symmetries of the board to every position
+    '''
+    self.states = np.asarray(states, dtype=np.int8)
+    self.policy_labels = np.asarray(policy_labels, dtype=np.float32)
+    self.value_labels = np.asarray(value_labels, dtype=np.float32)
+    self.augment = augment
+
+  def __len__(self):
+    return len(self.states)
+
+  def __getitem__(self, idx):
+    boards = self.states[idx]
+    policies = self.policy_labels[idx].reshape(boards.shape)
+    if self.augment:
+      # torch RNG since DataLoader seeds it differently in every worker (unlike numpy's)
+      ks = torch.randint(8, (len(idx),)).numpy()
+      boards, policies = boards.copy(), policies.copy()
+      for k in np.unique(ks).tolist():
+        sel = (ks == k)
+        boards[sel] = symmetry(boards[sel], k)
+        policies[sel] = symmetry(policies[sel], k)
+
+    states = np.stack([boards == 1, boards == -1], axis=1).astype(np.float32)
+    return torch.from_numpy(states), torch.from_numpy(policies.reshape(len(idx), -1)), torch.from_numpy(self.value_labels[idx])
+
 class DataBase:
   def __init__(self, args):
     '''
@@ -54,21 +136,26 @@ class DataBase:
         flip - transpose the state and policy (2x)
         rotate - rotate state and policy by 90 degrees (4x)
 
+      deduplicate - (optional) merge repeated positions before saving and batching (default False), the # of
+        positions merged into each one is kept in counts and saved with the chunks
     '''
 
     self.max_len = args["max_len"]
     self.augmentations = args["augmentations"]
+    self.dedup = args.get("deduplicate", False)
     self.augmentation_coefficient = 1
 
     self.states = deque([], maxlen=self.max_len)
     self.policy_labels = deque([], maxlen=self.max_len)
     self.value_labels = deque([], maxlen=self.max_len)
+    self.counts = deque([], maxlen=self.max_len) # positions merged into each position by deduplicate
     self.value_mask = []
 
   def clear(self):
     self.states.clear()
     self.policy_labels.clear()
     self.value_labels.clear()
+    self.counts.clear()
 
   def is_full(self):
     return len(self.states) == len(self.policy_labels) == len(self.value_labels) == self.max_len
@@ -86,12 +173,14 @@ class DataBase:
 
     self.states += aug_states 
     self.policy_labels += aug_policy_labels
+    self.counts += [1] * len(aug_states)
     self.augmentation_coefficient = len(aug_states)
 
-  def append_value(self, winner, game_length):
+  def append_value(self, winner, game_length, plies=None):
+    # plies - (optional) move numbers of the positions appended with append_policy, by default every move of the game
     val_labs = []
-    offset = (-1.0)**(winner == -1.0)
-    for i in range(game_length):
+    offset = (-1.0)**(winner == -1.0) if winner != 0 else 0.0 # draws are labelled 0
+    for i in (range(game_length) if plies is None else plies):
       val_labs += [offset * (-1.0)**(i%2 == 1)] * self.augmentation_coefficient
 
     if len(self.value_mask) == len(val_labs):
@@ -99,31 +188,54 @@ class DataBase:
       self.value_mask = []
     self.value_labels += val_labs
 
-  def save_data(self, path="./replay_buffer"):
-    prepared_states = [prepare_state(state) for state in self.states]
-    states = np.array(prepared_states)
-    pol_labels = np.array(self.policy_labels)
-    val_labels = np.array(self.value_labels)
+  def deduplicate(self):
+    # In place count-weighted deduplicate, returns the # of positions merged into each remaining one
+    states, policy_labels, value_labels, counts = deduplicate(self.states, self.policy_labels, self.value_labels, self.counts)
+    self.states = deque(states, maxlen=self.max_len)
+    self.policy_labels = deque(policy_labels, maxlen=self.max_len)
+    self.value_labels = deque(value_labels, maxlen=self.max_len)
+    self.counts = deque(counts, maxlen=self.max_len)
+    return counts
 
-    try:
-      largest_index = max([int(name[12:-4]) for name in os.listdir(os.path.join(path, "states"))])
-    except ValueError:
-      largest_index = -1
+  def take_buffer(self):
+    # Hands over the stored positions and their counts (e.g. to a ChunkWriter, which deduplicates them) and starts empty ones
+    buffer = (self.states, self.policy_labels, self.value_labels, self.counts)
+    self.states = deque([], maxlen=self.max_len)
+    self.policy_labels = deque([], maxlen=self.max_len)
+    self.value_labels = deque([], maxlen=self.max_len)
+    self.counts = deque([], maxlen=self.max_len)
+    return buffer
 
-    print(f"Saving replay chunk #{largest_index+1} of {len(states)} positions...")
-    np.save(os.path.join(path, "states", f"state_chunk_{largest_index+1}"), states)
-    np.save(os.path.join(path, "policy_labels", f"policy_chunk_{largest_index+1}"), pol_labels)
-    np.save(os.path.join(path, "value_labels", f"value_chunk_{largest_index+1}"), val_labels)
+  def save_data(self, path="./replay_buffer", generation=0):
+    # generation - generation of the model that played the games
+    write_chunk(path, self.states, self.policy_labels, self.value_labels, self.counts, generation, self.dedup)
 
   def load_data(self, path, chunk_num):
     states = np.load(os.path.join(path, "states", f"state_chunk_{chunk_num}.npy"))
     policy_labels = np.load(os.path.join(path, "policy_labels", f"policy_chunk_{chunk_num}.npy"))
     value_labels = np.load(os.path.join(path, "value_labels", f"value_chunk_{chunk_num}.npy"))
+    counts_path = os.path.join(path, "counts", f"count_chunk_{chunk_num}.npy")
+    counts = np.load(counts_path) if os.path.exists(counts_path) else np.ones(len(states)) # chunks from before counts
 
     for i, state in enumerate(states):
       self.states.append(unprepare_state(state))
       self.policy_labels.append(policy_labels[i])
       self.value_labels.append(value_labels[i])
+      self.counts.append(counts[i])
+
+  def as_arrays(self):
+    # Prepared states, policy labels and value labels of the positions in memory
+    if self.dedup:
+      self.deduplicate()
+    return np.array([prepare_state(state) for state in self.states]), np.array(self.policy_labels), np.array(self.value_labels)
+
+  def dataset(self, augment=True):
+    # On-the-fly augmentation is only applied when append_policy doesn't already store the augmented copies
+    # (augmentations is empty), with both every position would still be there 8x and the random symmetry adds nothing
+    if self.dedup:
+      self.deduplicate()
+    augment = augment and len(self.augmentations) == 0
+    return ReplayDataset(np.array(self.states), np.array(self.policy_labels), np.array(self.value_labels), augment)
 
   def prepare_batches(self, batch_size, from_memory_paths=None):
 
@@ -131,9 +243,7 @@ class DataBase:
 
     # Numpy-ify
     if from_memory_paths is None:
-      train_states = np.array([prepare_state(state) for state in self.states])
-      train_policy_labels = np.array(self.policy_labels)
-      train_value_labels = np.array(self.value_labels)
+      train_states, train_policy_labels, train_value_labels = self.as_arrays()
     else:
       train_states = np.load(os.path.join(from_memory_paths[0]))
       train_policy_labels = np.load(os.path.join(from_memory_paths[1]))
@@ -156,3 +266,132 @@ class DataBase:
     batched_value_labels = np.split(train_value_labels, batch_count)
     
     return batched_states, batched_policy_labels, batched_value_labels
+
+def save_atomic(path, array):
+  # Written to a hidden temporary file first so readers never see a partial chunk
+  directory, name = os.path.split(path)
+  tmp_path = os.path.join(directory, f".{name}.tmp")
+  with open(tmp_path, "wb") as f:
+    np.save(f, array)
+  os.replace(tmp_path, path)
+
+def read_manifest(path):
+  '''
+    Replay buffer manifest (path/manifest.json), safe to read without the lock since it's replaced atomically
+
+    next_chunk - next free chunk number
+    chunks - list of written chunks, {"chunk": chunk number, "positions": # of positions,
+      "generation": generation of the model that played the games, "timestamp": time the chunk was written}
+  '''
+  try:
+    with open(os.path.join(path, "manifest.json")) as f:
+      return json.load(f)
+  except FileNotFoundError:
+    # Buffers from before the manifest, their chunks are found once with listdir
+    chunks = []
+    for name in os.listdir(os.path.join(path, "states")):
+      if name.startswith("state_chunk_") and name.endswith(".npy"):
+        states = np.load(os.path.join(path, "states", name), mmap_mode="r")
+        chunks.append({"chunk": int(name[12:-4]), "positions": len(states), "generation": 0,
+          "timestamp": os.path.getmtime(os.path.join(path, "states", name))})
+    chunks.sort(key=lambda chunk: chunk["chunk"])
+    return {"next_chunk": max([chunk["chunk"] for chunk in chunks], default=-1) + 1, "chunks": chunks}
+
+@contextmanager
+def locked_manifest(path):
+  # Read-modify-write of the manifest under an exclusive lock shared by all processes writing to path
+  with open(os.path.join(path, "manifest.lock"), "a") as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+      manifest = read_manifest(path)
+      yield manifest
+      tmp_path = os.path.join(path, ".manifest.json.tmp")
+      with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+      os.replace(tmp_path, os.path.join(path, "manifest.json"))
+    finally:
+      fcntl.flock(lock, fcntl.LOCK_UN)
+
+def allocate_chunk(path):
+  with locked_manifest(path) as manifest:
+    chunk_num = manifest["next_chunk"]
+    manifest["next_chunk"] += 1
+  return chunk_num
+
+def chunk_numbers(path):
+  # Numbers of the complete chunks in path, in the order they were written
+  return [chunk["chunk"] for chunk in read_manifest(path)["chunks"]]
+
+def write_chunk(path, states, policy_labels, value_labels, counts, generation=0, dedup=False):
+  # counts - # of positions merged into each position, dedup - (count-weighted) deduplicate before writing
+  if dedup:
+    states, policy_labels, value_labels, counts = deduplicate(states, policy_labels, value_labels, counts)
+  states = prepare_states(states)
+  pol_labels = np.array(policy_labels)
+  val_labels = np.array(value_labels)
+
+  # Chunk numbers come from the manifest so concurrent writers never pick the same one
+  chunk_num = allocate_chunk(path)
+
+  print(f"Saving replay chunk #{chunk_num} of {len(states)} positions...")
+  # The states file goes last, a chunk is complete once it's there (and listed in the manifest)
+  save_atomic(os.path.join(path, "policy_labels", f"policy_chunk_{chunk_num}.npy"), pol_labels)
+  save_atomic(os.path.join(path, "value_labels", f"value_chunk_{chunk_num}.npy"), val_labels)
+  os.makedirs(os.path.join(path, "counts"), exist_ok=True) # not in buffers from before counts
+  save_atomic(os.path.join(path, "counts", f"count_chunk_{chunk_num}.npy"), np.array(counts, dtype=np.float64))
+  save_atomic(os.path.join(path, "states", f"state_chunk_{chunk_num}.npy"), states)
+
+  with locked_manifest(path) as manifest:
+    manifest["chunks"].append({"chunk": chunk_num, "positions": len(states), "generation": generation, "timestamp": time.time()})
+
+class ChunkWriter:
+  def __init__(self, path, generation=0, dedup=False, max_pending=2):
+    '''
+      Background thread writing replay chunks (write_chunk) so self-play doesn't wait on saving
+
+      path - replay buffer directory
+      generation - generation of the model that played the games
+      dedup - deduplicate every buffer before writing it (in the writer thread)
+      max_pending - maximum number of buffers waiting to be written, put blocks when the writer falls behind
+
+      A failed write doesn't stop the thread, its error is raised from the next check, put or close
+    '''
+    self.path = path
+    self.generation = generation
+    self.dedup = dedup
+    self.error = None # (exception, buffer) of the last failed write
+    self.queue = queue.Queue(maxsize=max_pending)
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def check(self):
+    # Raises the error of a failed write, the buffer that failed is queued again so it's retried
+    if self.error is not None:
+      error, buffer = self.error
+      self.error = None
+      self.queue.put(buffer)
+      raise error
+
+  def put(self, buffer):
+    # buffer - (states, policy_labels, value_labels, counts) the writer takes ownership of, e.g. from DataBase.take_buffer
+    self.check()
+    self.queue.put(buffer)
+
+  def run(self):
+    while True:
+      buffer = self.queue.get()
+      if buffer is None:
+        break
+      try:
+        write_chunk(self.path, *buffer, self.generation, self.dedup)
+      except Exception as e:
+        self.error = (e, buffer)
+
+  def close(self):
+    # Waits for the pending chunks to be written
+    self.queue.put(None)
+    self.thread.join()
+    if self.error is not None:
+      error, _ = self.error
+      self.error = None
+      raise error
@@ -1,9 +1,14 @@
+import os
+import time
+import torch
 import argparse
 import numpy as np
-from multiprocessing import Process
+from multiprocessing import Process, Queue
 
+from mcts import MCTS
 from model import ZeroTTT
 from trainer import Trainer
+from metrics import Metrics, latest_records, aggregate_metrics, write_prometheus
 
 model_args = {
   "board_len": 10,
@@ -29,10 +34,29 @@ args = {
   "board_len": 10
 }     
 
-def manage_trainer(model_name, opt_state_name, model_args, trainer_args, buffer_path, seed):
+def configure_worker_threads(n_threads, cpus=None):
+  # Has to run in the worker before it does any torch work, otherwise every worker spins up a full-size thread pool
+  os.environ["OMP_NUM_THREADS"] = str(n_threads)
+  os.environ["MKL_NUM_THREADS"] = str(n_threads)
+  torch.set_num_threads(n_threads)
+  try:
+    torch.set_num_interop_threads(1)
+  except RuntimeError: # already set (or used) in this process
+    pass
+  if cpus is not None:
+    os.sched_setaffinity(0, cpus)
+
+def worker_cpus(worker_nr, n_threads):
+  # Consecutive block of n_threads cpus out of the ones this process may run on
+  available = sorted(os.sched_getaffinity(0))
+  return [available[(worker_nr*n_threads + i) % len(available)] for i in range(n_threads)]
+
+def manage_trainer(model_name, opt_state_name, model_args, trainer_args, buffer_path, seed, n_threads=1, cpus=None, metrics_path=None):
+  configure_worker_threads(n_threads, cpus)
   np.random.seed(seed)
   model = ZeroTTT(model_name, opt_state_name, model_args)
-  trainer = Trainer(model, args)
+  metrics = Metrics(seed, os.path.join(metrics_path, f"worker_{seed}.jsonl") if metrics_path is not None else None)
+  trainer = Trainer(model, trainer_args, metrics)
   while True:
     try:
       trainer.generate_buffer(buffer_path)
@@ -40,21 +64,89 @@ def manage_trainer(model_name, opt_state_name, model_args, trainer_args, buffer_
       break
     except Exception as e:
       print(e)
+  trainer.close()
   
+def benchmark_worker(model_name, model_args, mcts_args, n_threads, cpus, duration, results):
+  configure_worker_threads(n_threads, cpus)
+  model = ZeroTTT(model_name, None, model_args)
+  model.brain.eval()
+  board = np.zeros((model_args["board_len"], model_args["board_len"]))
+  search_args = dict(mcts_args, num_simulations=50)
+
+  simulations = 0
+  start = time.perf_counter()
+  while time.perf_counter() - start < duration:
+    MCTS(model, board, search_args).search()
+    simulations += search_args["num_simulations"]
+  results.put(simulations / (time.perf_counter() - start))
+
+def benchmark_layouts(model_name, model_args, mcts_args, duration=20.0, pin_cpus=True):
+  '''
+    Runs the same search workload under every workers x threads layout that fills the host
+    and returns the layouts with their total simulations per second, fastest first
+  '''
+  n_cpus = len(os.sched_getaffinity(0))
+  layouts = [(n_workers, n_cpus // n_workers) for n_workers in range(1, n_cpus + 1) if n_cpus % n_workers == 0]
+
+  scores = []
+  for n_workers, n_threads in layouts:
+    results = Queue()
+    processes = [Process(target=benchmark_worker, args=(model_name, model_args, mcts_args, n_threads,
+      worker_cpus(nr, n_threads) if pin_cpus else None, duration, results)) for nr in range(n_workers)]
+    for proc in processes:
+      proc.start()
+    sims_per_sec = sum(results.get() for _ in processes)
+    for proc in processes:
+      proc.join()
+
+    print(f"{n_workers} workers x {n_threads} threads: {sims_per_sec:.1f} simulations/sec")
+    scores.append(((n_workers, n_threads), sims_per_sec))
+
+  return sorted(scores, key=lambda score: -score[1])
+
 class Manager:
-  def __init__(self, model_name, opt_state_name, model_args, trainer_args, buffer_path, n_proc):
+  def __init__(self, model_name, opt_state_name, model_args, trainer_args, buffer_path, n_proc, threads_per_worker=None, pin_cpus=False,
+    metrics_path=None, metrics_interval=60.0):
     if model_name == "None":
         model_name = None
     if opt_state_name == "None":
         opt_state_name = None
 
-    self.processes = [Process(target=manage_trainer, args=(model_name, opt_state_name, model_args, trainer_args, buffer_path, nr)) for nr in range(n_proc)]
+    if threads_per_worker is None:
+      threads_per_worker = max(1, len(os.sched_getaffinity(0)) // n_proc)
+
+    self.metrics_path = metrics_path
+    self.metrics_interval = metrics_interval
+    if self.metrics_path is not None:
+      os.makedirs(self.metrics_path, exist_ok=True)
+
+    self.processes = []
+    for nr in range(n_proc):
+      cpus = worker_cpus(nr, threads_per_worker) if pin_cpus else None
+      self.processes.append(Process(target=manage_trainer, args=(model_name, opt_state_name, model_args, trainer_args, buffer_path, nr,
+        threads_per_worker, cpus, metrics_path)))
+
+  def report_metrics(self):
+    # Aggregate the workers' JSON-lines metrics and expose them as a Prometheus text file
+    records = latest_records(self.metrics_path)
+    if len(records) == 0:
+      return
+    write_prometheus(records, os.path.join(self.metrics_path, "selfplay.prom"))
+    total = aggregate_metrics(records)
+    print(f"[{total['workers']} workers] {total['simulations_per_sec']:.1f} simulations/sec, {total['nn_evals_per_sec']:.1f} evals/sec, "
+      f"{total['positions_written_per_sec']:.2f} positions/sec, cache hit rate {total['cache_hit_rate']:.2f}, "
+      f"avg game length {total['avg_game_length']:.1f}")
 
   def start(self):
     print("Starting...")
     for proc in self.processes:
       proc.start()
 
+    if self.metrics_path is not None:
+      while any(proc.is_alive() for proc in self.processes):
+        time.sleep(self.metrics_interval)
+        self.report_metrics()
+
     for proc in self.processes:
       proc.join()
 
@@ -65,6 +157,12 @@ def get_arg_parser():
   parser.add_argument("opt_state_name", type=str, help="Name of optimizer state stored in TTTArena/mcts/models")
   parser.add_argument("n_trainers", type=int, help="Number of trainers")
   parser.add_argument("buffer_path", type=str, help="Path to replay buffer")
+  parser.add_argument("--threads_per_worker", type=int, default=None, help="torch/OMP threads per trainer (default: cpus // n_trainers)")
+  parser.add_argument("--pin_cpus", action="store_true", help="Pin every trainer to its own block of cpus")
+  parser.add_argument("--metrics_path", type=str, default=None, help="Directory for per-trainer JSON-lines metrics and the aggregated selfplay.prom")
+  parser.add_argument("--generation", type=int, default=0, help="Generation of the model, recorded in the replay manifest")
+  parser.add_argument("--parallel_games", type=int, default=1, help="Games every trainer plays at once with batched network evaluations")
+  parser.add_argument("--benchmark_layouts", action="store_true", help="Pick the fastest trainers x threads layout for this host, overrides n_trainers")
 
   return parser
 
@@ -72,7 +170,16 @@ def main():
   parser = get_arg_parser()
   manager_args = parser.parse_args()
 
-  manager = Manager(manager_args.model_name, manager_args.opt_state_name, model_args, args, manager_args.buffer_path, manager_args.n_trainers)
+  n_trainers, threads_per_worker = manager_args.n_trainers, manager_args.threads_per_worker
+  # Handed to the workers as process arguments, module globals aren't shared under the spawn start method
+  trainer_args = dict(args, parallel_games=manager_args.parallel_games, generation=manager_args.generation)
+  if manager_args.benchmark_layouts:
+    model_name = None if manager_args.model_name == "None" else manager_args.model_name
+    (n_trainers, threads_per_worker), _ = benchmark_layouts(model_name, model_args, mcts_args, pin_cpus=manager_args.pin_cpus)[0]
+    print(f"Using {n_trainers} trainers x {threads_per_worker} threads")
+
+  manager = Manager(manager_args.model_name, manager_args.opt_state_name, model_args, trainer_args, manager_args.buffer_path, n_trainers,
+    threads_per_worker, manager_args.pin_cpus, manager_args.metrics_path)
   manager.start()
 
 if __name__ == "__main__":
@@ -7,9 +7,9 @@ from copy import deepcopy
 
 sys.path.append(os.path.join(os.environ["HOME"], "TTTArena"))
 
-from environment import Environment
-
 from alphazero.database import prepare_state
+from alphazero.threats import ThreatSolver, PatternTable
+from alphazero.transposition import Zobrist, Node, TranspositionTable
 
 np.random.seed(80085)
 random.seed(80085)
@@ -18,127 +18,425 @@ def PUCT_score(child_value, child_prior, parent_visit_count, child_visit_count,
   pb_c = child_prior * math.sqrt(parent_visit_count) / (child_visit_count + 1)
   return child_value + c_puct * pb_c
 
+def visits_to_pi(move_dist, tau=1.0):
+  if tau < 0.1: # protecting from numerical overflow 
+    z = np.zeros(move_dist.shape)
+    move = np.unravel_index(np.argmax(move_dist), move_dist.shape)
+    z[move[0]][move[1]] = 1.0
+    move_dist = z
+  else:
+    move_dist = np.power(move_dist, 1.0/tau)
+  if np.sum(move_dist) > 0.0:
+    move_dist /= np.sum(move_dist)
+  return move_dist
+
+class Neighbourhood():
+  def __init__(self, board, radius):
+    '''
+      Incrementally maintained number of stones within (Chebyshev) distance radius of every cell,
+      used to restrict the candidate moves to cells near the existing stones
+    '''
+    board_len = len(board)
+    self.windows = [(slice(max(0, i - radius), i + radius + 1), slice(max(0, j - radius), j + radius + 1))
+      for i in range(board_len) for j in range(board_len)]
+    self.counts = np.zeros((board_len, board_len), dtype=np.int32)
+    self.stones = 0
+
+    # On an empty board the candidates are the cells around the center
+    self.center = np.zeros((board_len, board_len), dtype=bool)
+    self.center[self.windows[(board_len//2)*board_len + board_len//2]] = True
+
+    for cell in np.flatnonzero(board).tolist():
+      self.play(cell)
+
+  def play(self, cell):
+    self.counts[self.windows[cell]] += 1
+    self.stones += 1
+
+  def undo(self, cell):
+    self.counts[self.windows[cell]] -= 1
+    self.stones -= 1
+
+  def candidates(self, state):
+    empty = (state == 0)
+    mask = empty & (self.counts > 0) if self.stones > 0 else empty & self.center
+    return mask if mask.any() else empty
+
+class Leaf():
+  __slots__ = ["path", "state", "node", "mask"]
+
+  def __init__(self, path, state, node, mask):
+    # Simulation stopped at node, waiting for a network evaluation of state over mask if mask isn't None
+    self.path = path # (node, child index) pairs from the root
+    self.state = state
+    self.node = node
+    self.mask = mask
+
 class MCTS():
-  def __init__(self, model, root_state, args):
+  def __init__(self, model, root_state, args, metrics=None):
     '''
       model - class with predict method that returns a valid policy and value
       root_state - board_len x board_len array with the initial state of the game
+      metrics - (optional) Metrics that counts simulations, network evaluations and cache hits
 
       args:
         num_simulations - number of leaf node expansions per search
         alpha - mixing constant between policy and dirichlet noise
         dirichlet_alpha - dirichlet constant for generating dirichlet distribution
         c_puct - exploration constant in PUCT score
+        tt_size - (optional) log2 of the number of transposition table slots (default 18)
+        candidate_radius - (optional) only expand empty cells within this distance of existing stones
+        widening_base - (optional) turns on progressive widening, a node visited Ns times only exposes its
+          widening_base + widening_factor * Ns^widening_exponent children with the highest priors
+        widening_factor - (optional) default 1.0
+        widening_exponent - (optional) default 0.5
+        vcf_budget - (optional) run the threat solver with this node budget on every new node, nodes it proves
+          won or lost become terminal without a network evaluation and nodes with a forced block only get that move
+        shortcut_tactics - (optional) nodes where the player to move can complete a five are won, nodes where they
+          have to block a five only get the blocking move as a child and nodes with two fives to block are lost
+        max_memory_mb - (optional) hard cap on the memory held by search nodes
+        gumbel - (optional) Gumbel AlphaZero root search: instead of dirichlet noise and visit counts the root samples
+          gumbel_m actions without replacement (Gumbel-top-k) and splits the simulations between them with sequential
+          halving, the move played is the last action left and the policy target is the improved policy
+        gumbel_m - (optional) number of sampled root actions (default 16)
+        c_visit, c_scale - (optional) scaling of the Q values added to the logits (default 50 and 1.0)
     '''
 
     self.model = model
     self.root = deepcopy(root_state)
     self.args = args
+    self.metrics = metrics
+
+    # Nodes (terminal status, priors and statistics) are keyed by the incrementally updated Zobrist key of their state
+    self.zobrist = Zobrist(len(self.root))
+    max_memory_mb = self.args.get("max_memory_mb")
+    self.tt = TranspositionTable(self.args.get("tt_size", 18), 2**20 * max_memory_mb if max_memory_mb else None)
+    self.root_key = self.zobrist.hash(self.root)
+    self.tt.protected_key = self.root_key[0]
+
+    # Candidate moves are kept up to date along the search path as moves are made and unmade
+    radius = self.args.get("candidate_radius")
+    self.neighbourhood = Neighbourhood(self.root, radius) if radius else None
 
-    self.Qsa = {} # self.Qsa(s, a) = Q value for (s, a)
-    self.Nsa = {} # self.Nsa(s, a) = (s, a) visit count
-    self.Ns = {} # self.Ns(s) = s visit count
-    self.Ps = {} # self.Ps(s) = list of available actions in s and corresponding raw probabilities
+    # Lines of 5 stone counts, new nodes get their terminal status from the lines through the last move instead of
+    # a scan of the whole board, and they're used for the immediate win / must block shortcut
+    self.patterns = PatternTable(self.root)
+    self.shortcut_tactics = self.args.get("shortcut_tactics", False)
 
-    self.Es = {} # terminal states, potentially going to do this if not too computationally expensive and dirty
+    # Incrementally updated state (besides the keys) that follows the search path
+    self.trackers = [tracker for tracker in (self.neighbourhood, self.patterns) if tracker is not None]
+
+    # Children are kept sorted by prior when widening so exposing more of them is just a longer slice
+    self.widening = self.args.get("widening_base") is not None
+
+    self.solver = ThreatSolver(len(self.root), self.args["vcf_budget"]) if self.args.get("vcf_budget") else None
+
+    # Exploration comes from the gumbel noise at the root instead of dirichlet noise
+    self.gumbel = self.args.get("gumbel", False)
+    self.gumbel_action = None # root action picked by the last search
 
     # Add dirichlet noise to initial root node
     self.add_dirichlet()
 
+  def root_node(self):
+    node = self.tt.get(self.root_key[0])
+    if node is None or (node.terminal == -1 and node.moves is None and self.patterns.terminal() == 10):
+      # A root proven lost by tactics is still searched normally to find the most stubborn move
+      node = self.expand(deepcopy(self.root), self.root_key[0], prove_loss=False)
+      self.tt.store(node, force=True)
+    return node
+
   def add_dirichlet(self):
-    rs = self.root.tobytes()
-    if rs not in self.Ps:
-      self.find_leaf(deepcopy(self.root))
-    if self.Es[rs] == 10:
-      dirichlet = np.random.dirichlet([self.args["dirichlet_alpha"]]*len(self.Ps[rs]))
-      for i, (move, prob) in enumerate(self.Ps[rs]):
-        self.Ps[rs][i] = (move, (1 - self.args["alpha"]) * prob + dirichlet[i] * self.args["alpha"])
-
-  def search(self): # builds the search tree from the root node
-    for i in range(self.args["num_simulations"]):
-      self.find_leaf(deepcopy(self.root))
+    node = self.root_node()
+    if node.terminal == 10 and not self.gumbel:
+      dirichlet = np.random.dirichlet([self.args["dirichlet_alpha"]]*len(node.moves))
+      node.P = (1 - self.args["alpha"]) * node.P + dirichlet * self.args["alpha"]
+      if self.widening:
+        self.sort_children(node)
+      self.tt.resize(node)
+
+  def sort_children(self, node):
+    order = np.argsort(-node.P, kind="stable")
+    node.moves, node.P, node.N, node.Q = node.moves[order], node.P[order], node.N[order], node.Q[order]
+
+  def widening_width(self, visit_count):
+    return int(self.args["widening_base"] + self.args.get("widening_factor", 1.0) * visit_count**self.args.get("widening_exponent", 0.5))
+
+  def search(self, num_simulations=None): # builds the search tree from the root node
+    num_simulations = num_simulations or self.args["num_simulations"]
+    if self.gumbel:
+      return self.gumbel_search(num_simulations)
+    for i in range(num_simulations):
+      self.find_leaf(deepcopy(self.root), self.root_key)
+    if self.metrics is not None:
+      self.metrics.count("simulations", num_simulations)
     return
 
-  def find_leaf(self, state):
-    s = state.tobytes()
+  def gumbel_search(self, n):
+    # Sequential halving over the gumbel_m actions with the highest g + logits
+    node = self.root_node()
+    self.gumbel_action = None
+    if node.terminal != 10:
+      return
+    m = min(self.args.get("gumbel_m", 16), len(node.moves), n)
+    g = np.random.gumbel(size=len(node.moves))
+    logits = np.log(np.maximum(node.P, 1e-12))
+    considered = np.argsort(-(g + logits), kind="stable")[:m]
+
+    # Every phase gets an equal share of the remaining budget (at least one visit per action while it lasts)
+    # and the last phase gets all of what's left, so exactly n simulations are run
+    remaining = n
+    while True:
+      phases_left = math.ceil(math.log2(len(considered)))
+      budget = remaining if phases_left <= 1 else min(remaining, max(len(considered), remaining // phases_left))
+      visits, extra = divmod(budget, len(considered))
+      for rank, i in enumerate(considered.tolist()): # the extra visits go to the best ranked actions
+        for _ in range(visits + (rank < extra)):
+          self.visit_child(node, i, deepcopy(self.root), self.root_key)
+      remaining -= budget
+
+      scores = g[considered] + logits[considered] + self.sigma(node, self.completed_q(node)[considered])
+      considered = considered[np.argsort(-scores, kind="stable")]
+      if len(considered) == 1:
+        break
+      considered = considered[:math.ceil(len(considered) / 2)]
+    self.gumbel_action = int(node.moves[considered[0]])
+
+    if self.metrics is not None:
+      self.metrics.count("simulations", n)
+
+  def sigma(self, node, q):
+    # Monotone transformation of Q values (in [-1, 1]) that is added to the logits
+    return (self.args.get("c_visit", 50) + node.N.max()) * self.args.get("c_scale", 1.0) * (q + 1) / 2
+
+  def completed_q(self, node):
+    # Q values with the unvisited actions getting the value estimate of the node mixed with the visited Qs
+    visited = node.N > 0
+    if not visited.any():
+      return np.full(len(node.moves), node.value)
+    prior_visited = node.P[visited].sum()
+    v_mix = (node.value + node.N.sum() / max(prior_visited, 1e-12) * (node.P[visited] * node.Q[visited]).sum()) / (1 + node.N.sum())
+    return np.where(visited, node.Q, v_mix)
+
+  def improved_policy(self):
+    # softmax(logits + sigma(completed Q))
+    node = self.root_node()
+    if node.terminal != 10 or node.N.sum() == 0:
+      return self.get_pi()
+
+    scores = np.log(np.maximum(node.P, 1e-12)) + self.sigma(node, self.completed_q(node))
+    probs = np.exp(scores - scores.max())
+    pi = np.zeros((len(self.root), len(self.root)))
+    pi.flat[node.moves] = probs / probs.sum()
+    return pi
 
-    if s not in self.Es:
-      self.Es[s] = Environment.game_over(state)
-    if self.Es[s] != 10:
+  def policy_target(self):
+    return self.improved_policy() if self.gumbel else self.get_pi()
+
+  def evaluate(self, state, legal_mask):
+    if self.metrics is None:
+      return self.model.predict(prepare_state(state), legal_mask=legal_mask)
+    self.metrics.count("nn_evals")
+    with self.metrics.timer("inference"):
+      return self.model.predict(prepare_state(state), legal_mask=legal_mask)
+
+  def expand(self, state, key, prove_loss=True):
+    node, availability_mask = self.expand_begin(state, key, prove_loss)
+    if availability_mask is not None:
+      p, v = self.evaluate(state, availability_mask) # policy comes back re-normalized over the available moves
+      self.expand_finish(node, availability_mask, p, v)
+    else:
+      self.tt.store(node)
+    return node
+
+  def expand_begin(self, state, key, prove_loss=True):
+    # New node with its terminal status and the mask of moves the network has to evaluate (None if it's terminal),
+    # state has to be the position the trackers are at
+    node = Node(key, self.tt.generation, self.patterns.terminal())
+    forced = None # mask of the only moves that don't lose right away
+    if node.terminal == 10 and self.solver is not None:
+      result, move = self.solver.solve(state)
+      if result == 1 or (result == -1 and prove_loss): # tactically decided
+        node.terminal = result
+        if move is not None:
+          node.moves = np.array([move[0]*len(state) + move[1]])
+      elif result == 0: # has to block the opponent's five
+        forced = np.zeros(state.shape, dtype=bool)
+        forced[move] = True
+    if node.terminal == 10 and forced is None and self.shortcut_tactics:
+      wins = self.patterns.wins(state)
+      threats = self.patterns.threats(state) if len(wins) == 0 else []
+      if len(wins) > 0:
+        node.terminal, node.moves = 1, wins[:1]
+      elif len(threats) > 1 and prove_loss:
+        node.terminal = -1
+      elif len(threats) == 1:
+        forced = np.zeros(state.shape, dtype=bool)
+        forced.flat[threats] = True
+    if node.terminal != 10:
+      return node, None
+    if forced is not None:
+      return node, forced
+    if self.neighbourhood is not None:
+      return node, self.neighbourhood.candidates(state)
+    return node, (state == 0)
+
+  def expand_finish(self, node, availability_mask, p, v):
+    node.moves = np.flatnonzero(availability_mask)
+    node.P = p.flatten()[node.moves]
+    node.N = np.zeros(len(node.moves), dtype=np.int64)
+    node.Q = np.zeros(len(node.moves))
+    node.value = v
+    if self.widening:
+      self.sort_children(node)
+    self.tt.store(node)
+
+  def find_leaf(self, state, keys):
+    node = self.tt.get(keys[0])
+
+    if self.metrics is not None:
+      self.metrics.count("cache_lookups")
+      self.metrics.count("cache_hits", node is not None)
+
+    if node is None: # expand leaf node
+      node = self.expand(state, keys[0])
+      return -node.terminal if node.terminal != 10 else -node.value
+
+    if node.terminal != 10:
       # terminal state
-      return -self.Es[s]
-
-    if s not in self.Ps: # expand leaf node
-      p, v = self.model.predict(prepare_state(state)) 
-      availability_mask = (state == 0)
-      p *= availability_mask
-      if np.sum(p) > 0.0:
-        p /= np.sum(p) # re-normalize
-
-      move_probs = []
-
-      for i, row in enumerate(p): 
-        for j, prob in enumerate(row):
-          if state[i][j] == 0:
-            move_probs.append(((i, j), prob))
-   
-      self.Ps[s] = move_probs
-      self.Ns[s] = 1
-      return -v
-
-    max_puct = -float('inf')
-    max_action = None
-
-    for move, prob in self.Ps[s]:
-      (Nc, Qc) = (self.Nsa[(s, move)], self.Qsa[(s, move)]) if (s, move) in self.Nsa else (0, 0.0)
-      puct = PUCT_score(Qc, prob, self.Ns[s], Nc, self.args["c_puct"])
-      if puct > max_puct:
-        max_puct = puct
-        max_action = move
-
-    a = max_action
-    state[a] = 1
+      return -node.terminal
+
+    return self.visit_child(node, self.select_child(node), state, keys)
+
+  def select_child(self, node):
+    # PUCT scores of all (exposed) children at once
+    if not self.widening:
+      return np.argmax(PUCT_score(node.Q, node.P, node.Ns, node.N, self.args["c_puct"]))
+    k = self.widening_width(node.Ns)
+    return np.argmax(PUCT_score(node.Q[:k], node.P[:k], node.Ns, node.N[:k], self.args["c_puct"]))
+
+  def visit_child(self, node, i, state, keys):
+    # Plays the i-th child of node, continues the simulation from there and backs up the result
+    a = node.moves[i]
+    state.flat[a] = 1
     state *= -1
 
-    v = self.find_leaf(state)
+    for tracker in self.trackers:
+      tracker.play(a)
+    v = self.find_leaf(state, self.zobrist.play(keys, a))
+    for tracker in self.trackers:
+      tracker.undo(a)
 
-    if (s, a) in self.Nsa:
-      self.Nsa[(s, a)] += 1
-      self.Qsa[(s, a)] = (self.Nsa[(s, a)] * self.Qsa[(s, a)] + v) / (self.Nsa[(s, a)] + 1)
-    else:
-      self.Nsa[(s, a)] = 1
-      self.Qsa[(s, a)] = v
-      
-    self.Ns[s] += 1
+    self.update(node, i, v)
     return -v
 
+  def update(self, node, i, v):
+    if node.N[i] > 0:
+      node.N[i] += 1
+      node.Q[i] = (node.N[i] * node.Q[i] + v) / (node.N[i] + 1)
+    else:
+      node.N[i] = 1
+      node.Q[i] = v
+    node.Ns += 1
+
+  def select_leaf(self):
+    '''
+      First half of a simulation (find_leaf split in two for batched evaluation): walks down from the root to
+      a terminal node or a new node, the new node's evaluation is left to the caller
+
+      returns Leaf, pass it to backup (after expand_finish with the network output if leaf.mask isn't None)
+    '''
+    state, keys, path = deepcopy(self.root), self.root_key, []
+    while True:
+      node = self.tt.get(keys[0])
+      if self.metrics is not None:
+        self.metrics.count("cache_lookups")
+        self.metrics.count("cache_hits", node is not None)
+
+      if node is None:
+        node, availability_mask = self.expand_begin(state, keys[0])
+        if availability_mask is None:
+          self.tt.store(node)
+        break
+      if node.terminal != 10:
+        availability_mask = None
+        break
+
+      i = self.select_child(node)
+      a = node.moves[i]
+      state.flat[a] = 1
+      state *= -1
+      for tracker in self.trackers:
+        tracker.play(a)
+      path.append((node, i))
+      keys = self.zobrist.play(keys, a)
+
+    for node_, i in reversed(path):
+      for tracker in self.trackers:
+        tracker.undo(node_.moves[i])
+    return Leaf(path, state, node, availability_mask)
+
+  def backup(self, leaf):
+    # Second half of a simulation, same updates as find_leaf on its way back up
+    v = -leaf.node.terminal if leaf.node.terminal != 10 else -leaf.node.value
+    for node, i in reversed(leaf.path):
+      self.update(node, i, v)
+      v = -v
+
+  def reachable_keys(self):
+    # Keys of the nodes in the tree under the root, following visited children
+    reachable = set()
+    stack = [self.root_key]
+    while stack:
+      keys = stack.pop()
+      node = self.tt.get(keys[0])
+      if node is None or keys[0] in reachable:
+        continue
+      reachable.add(keys[0])
+      if node.N is not None:
+        for cell in node.moves[node.N > 0].tolist():
+          stack.append(self.zobrist.play(keys, cell))
+    return reachable
+
+  def memory_stats(self):
+    return {"nodes": self.tt.nodes, "bytes": self.tt.bytes}
+
   def get_pi(self, tau=1.0, as_prob=True):
     move_dist = np.zeros((len(self.root), len(self.root)))
-    rs = self.root.tobytes()
-    for move, _ in self.Ps[rs]:
-      move_dist[move] = self.Nsa[(rs, move)] if (rs, move) in self.Nsa else 0
+    node = self.root_node()
+    if node.terminal != 10 and node.moves is not None: # won by the threat solver, its move is the one to play
+      move_dist.flat[node.moves] = 1
+    else:
+      move_dist.flat[node.moves] = node.N
     if as_prob is True:
-      if tau < 0.1: # protecting from numerical overflow 
-        z = np.zeros(move_dist.shape)
-        move = np.unravel_index(np.argmax(move_dist), move_dist.shape)
-        z[move[0]][move[1]] = 1.0
-        move_dist = z
-      else:
-        move_dist = np.power(move_dist, 1.0/tau)
-      if np.sum(move_dist) > 0.0:
-        move_dist /= np.sum(move_dist)
+      move_dist = visits_to_pi(move_dist, tau)
     return move_dist
 
   def select_move(self, tau=1.0, external_move=None):
-    if external_move is None:
+    if external_move is None and self.gumbel_action is not None:
+      selected_move = np.unravel_index(self.gumbel_action, self.root.shape)
+    elif external_move is None:
       probas = self.get_pi(tau)
-      selected_move = int(np.random.choice(len(probas.flatten()), 1, p=probas.flatten()))
+      selected_move = int(np.random.choice(len(probas.flatten()), p=probas.flatten()))
       selected_move = np.unravel_index(selected_move, probas.shape)
     else:
       selected_move = external_move
 
+    cell = selected_move[0]*len(self.root) + selected_move[1]
+    self.root_key = self.zobrist.play(self.root_key, cell)
+    for tracker in self.trackers:
+      tracker.play(cell)
     self.root[selected_move] = 1
     self.root *= -1
+    self.gumbel_action = None
+
+    # Nodes from before this move are the first to go when the table fills up. With a memory cap the ones
+    # outside the tree under the new root are dropped right away (this also drops transpositions that were
+    # only reached through other moves, so it's skipped without a cap)
+    self.tt.new_generation()
+    self.tt.protected_key = self.root_key[0]
+    if self.tt.max_bytes is not None:
+      self.tt.collect(self.reachable_keys())
 
     # Add dirichlet noise to new root node:
     self.add_dirichlet()
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+from collections import defaultdict
+
+class Metrics:
+  '''
+    Cumulative counters and wall-clock timers of one self-play worker
+
+    worker_id - id written into every record
+    path - (optional) JSON-lines file every flush appends a record to
+
+    counters:
+      games, moves - finished self-play games and the moves played in them
+      simulations - MCTS simulations (find_leaf calls from search)
+      nn_evals - network evaluations during search
+      cache_hits, cache_lookups - terminal state cache hits out of all lookups
+      positions_written - positions saved to the replay buffer
+
+    timers (seconds):
+      search - time spent in MCTS.search, including inference
+      inference - time spent in the network during search
+      io - time spent saving replay chunks
+
+    samples (recorded as {name}_max and {name}_mean over the values since the last flush):
+      tree_nodes, tree_bytes - search nodes held by MCTS and their memory, sampled after every move
+  '''
+  def __init__(self, worker_id=0, path=None):
+    self.worker_id = worker_id
+    self.path = path
+    self.start_time = time.time()
+
+    self.counters = defaultdict(int)
+    self.timers = defaultdict(float)
+    self.samples = defaultdict(list)
+
+  def sample(self, name, value):
+    self.samples[name].append(value)
+
+  def count(self, name, n=1):
+    self.counters[name] += n
+
+  @contextmanager
+  def timer(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.timers[name] += time.perf_counter() - start
+
+  def snapshot(self):
+    elapsed = max(time.time() - self.start_time, 1e-9)
+    c, t = self.counters, self.timers
+    record = {
+      "worker": self.worker_id,
+      "timestamp": time.time(),
+      "elapsed": elapsed,
+      **{key: c[key] for key in ["games", "moves", "simulations", "nn_evals", "cache_hits", "cache_lookups", "positions_written"]},
+      "simulations_per_sec": c["simulations"] / elapsed,
+      "nn_evals_per_sec": c["nn_evals"] / elapsed,
+      "positions_written_per_sec": c["positions_written"] / elapsed,
+      "cache_hit_rate": c["cache_hits"] / max(c["cache_lookups"], 1),
+      "avg_game_length": c["moves"] / max(c["games"], 1),
+      "time_search": t["search"] - t["inference"], # search time excluding inference
+      "time_inference": t["inference"],
+      "time_io": t["io"]
+    }
+    for name, values in self.samples.items():
+      record[f"{name}_max"] = max(values)
+      record[f"{name}_mean"] = sum(values) / len(values)
+    return record
+
+  def flush(self):
+    record = self.snapshot()
+    self.samples.clear()
+    if self.path is not None:
+      with open(self.path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    return record
+
+def latest_records(metrics_dir):
+  # Last record written by every worker in metrics_dir
+  records = []
+  for name in sorted(os.listdir(metrics_dir)):
+    if not name.endswith(".jsonl"):
+      continue
+    last_line = None
+    with open(os.path.join(metrics_dir, name)) as f:
+      for line in f:
+        if line.strip():
+          last_line = line
+    if last_line is not None:
+      records.append(json.loads(last_line))
+  return records
+
+def aggregate_metrics(records):
+  # Combine the cumulative records of all workers into host-wide totals, rates add up across workers
+  total = defaultdict(float)
+  for record in records:
+    for key, value in record.items():
+      if key not in ["worker", "timestamp", "elapsed", "cache_hit_rate", "avg_game_length"]:
+        total[key] += value
+
+  total = dict(total)
+  total["workers"] = len(records)
+  total["cache_hit_rate"] = total.get("cache_hits", 0) / max(total.get("cache_lookups", 0), 1)
+  total["avg_game_length"] = total.get("moves", 0) / max(total.get("games", 0), 1)
+  return total
+
+def write_prometheus(records, path):
+  # Prometheus text exposition format (e.g. for node_exporter's textfile collector), written atomically
+  lines = []
+  for record in records:
+    for key, value in record.items():
+      if key not in ["worker", "timestamp"]:
+        lines.append(f'alphazero_selfplay_{key}{{worker="{record["worker"]}"}} {value}')
+  for key, value in aggregate_metrics(records).items():
+    lines.append(f'alphazero_selfplay_total_{key} {value}')
+
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w") as f:
+    f.write("\n".join(lines) + "\n")
+  os.replace(tmp_path, path)
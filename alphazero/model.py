@@ -16,12 +16,17 @@ from environment import Environment
 from alphazero.mcts import MCTS
 from alphazero.database import DataBase
 from alphazero.database import prepare_state
+from alphazero import quantization
 
 torch.manual_seed(80085)
 np.random.seed(80085)
 
+def model_path(name):
+  return os.path.join(os.environ["HOME"], "TTTArena/alphazero/models", name)
+
 def softXEnt (inp, target):
-  logprobs = torch.log(inp)
+  # Clamped so a policy output that underflows to 0 (easily in bf16) doesn't give log(0) = -inf
+  logprobs = torch.log(inp.float().clamp(min=1e-12))
   cross_entropy = -(target * logprobs).sum() / inp.shape[0]
   return cross_entropy
 
@@ -141,17 +146,29 @@ class ZeroTTT():
         board_len - # of rows and columns on board
         lr - learning rate
         weight_decay - weight decay
+        compile - (optional) run inference through a TorchScript trace of the brain cached in models
+        quantize - (optional) run inference through an int8 statically quantized copy of the brain (CPU)
+        calibration_path - (optional) replay buffer to calibrate the quantized brain on
+        bf16 - (optional) run the brain (training and float inference) under bfloat16 autocast
+        channels_last - (optional) keep the conv weights and inputs in channels-last memory format
     '''
     self.args = args
     self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     self.brain = Brain(input_shape=(2, self.args["board_len"], self.args["board_len"])).to(self.device)
+    if self.args.get("channels_last", False):
+      self.brain = self.brain.to(memory_format=torch.channels_last)
 
     self.policy_loss = softXEnt
     self.value_loss = nn.MSELoss()
     self.optimizer = optim.AdamW(self.brain.parameters(), lr=self.args["lr"], weight_decay=self.args["weight_decay"])
 
+    self.compiled_brain = None
+    self.quantized_brain = None
+
     if brain_path is not None:
       self.load_brain(brain_path, opt_path)
+    else:
+      self.prepare_inference()
 
   # TODO: fix for nested Modules
   def get_parameter_count(self):
@@ -159,27 +176,128 @@ class ZeroTTT():
 
   def save_brain(self, model_name, opt_state_name):
     print("Saving brain...")
-    torch.save(self.brain.state_dict(), os.path.join(os.environ["HOME"], "TTTArena/alphazero/models", model_name))
+    torch.save(self.brain.state_dict(), model_path(model_name))
     if opt_state_name is not None:
-      torch.save(self.optimizer.state_dict(), os.path.join(os.environ["HOME"], "TTTArena/alphazero/models", opt_state_name))
+      torch.save(self.optimizer.state_dict(), model_path(opt_state_name))
+    self.prepare_inference(model_name)
 
   def load_brain(self, model_name, opt_state_name):
     print("Loading brain...")
-    self.brain.load_state_dict(torch.load(os.path.join(os.environ["HOME"], "TTTArena/alphazero/models", model_name), map_location=self.device))
+    self.brain.load_state_dict(torch.load(model_path(model_name), map_location=self.device))
     if opt_state_name is not None:
-        self.optimizer.load_state_dict(torch.load(os.path.join(os.environ["HOME"], "TTTArena/alphazero/models", opt_state_name), map_location=self.device))
+        self.optimizer.load_state_dict(torch.load(model_path(opt_state_name), map_location=self.device))
+    self.prepare_inference(model_name)
     return
 
-  def predict(self, x, interpret_output=True):
+  def prepare_inference(self, model_name=None):
+    # Rebuild the optional inference copies of the brain so they match its current weights
+    if self.args.get("compile", False):
+      self.compile_brain(model_name)
+    if self.args.get("quantize", False):
+      self.quantize_brain(self.args.get("calibration_path"))
+
+  def compile_brain(self, model_name=None):
+    # Trace the brain with TorchScript for inference, the trace is cached next to the checkpoint (per device and
+    # memory format, which the trace is specialized to) and rebuilt whenever the checkpoint is newer than it
+    trace_path = None
+    if model_name is not None:
+      memory_format = "_channels_last" if self.args.get("channels_last", False) else ""
+      trace_path = model_path(f"{model_name}_traced_{self.device.type}{memory_format}")
+      if os.path.exists(trace_path) and os.path.getmtime(trace_path) >= os.path.getmtime(model_path(model_name)):
+        self.compiled_brain = torch.jit.load(trace_path, map_location=self.device)
+        return
+
+    print("Compiling brain...")
+    was_training = self.brain.training
+    self.brain.eval()
+    with torch.no_grad():
+      example = torch.zeros((1,) + tuple(self.brain.input_shape), device=self.device)
+      if self.args.get("channels_last", False):
+        example = example.contiguous(memory_format=torch.channels_last)
+      traced = torch.jit.freeze(torch.jit.trace(self.brain, example))
+    self.brain.train(was_training)
+
+    if trace_path is not None:
+      torch.jit.save(traced, trace_path)
+    self.compiled_brain = traced
+
+  def quantize_brain(self, buffer_path=None):
+    print("Quantizing brain...")
+    if buffer_path is not None:
+      calibration_states = quantization.load_calibration_states(buffer_path)
+    else:
+      print("No calibration_path, calibrating on random positions (less accurate than replay chunks)")
+      calibration_states = quantization.random_calibration_states(self.args["board_len"])
+    self.quantized_brain = quantization.quantize_brain(self.brain, calibration_states)
+
+  def inference_brain(self):
+    # Fastest available copy of the brain for inference and the device it expects its input on
+    if self.quantized_brain is not None:
+      return self.quantized_brain, torch.device("cpu")
+    if self.compiled_brain is not None:
+      return self.compiled_brain, self.device
+    return self.brain, self.device
+
+  def run_brain(self, brain, device, x):
+    # Forward pass with the optional channels-last input and bf16 autocast, the outputs come back in float32
+    if self.args.get("channels_last", False):
+      x = x.contiguous(memory_format=torch.channels_last)
+    bf16 = self.args.get("bf16", False) and brain is not self.quantized_brain
+    with torch.autocast(device.type, dtype=torch.bfloat16, enabled=bf16):
+      policy, value = brain(x)
+    return policy.float(), value.float()
+
+  def allocate_batch(self, batch_size, dtype=torch.float32):
+    # Preallocated input buffer for predict_batch (pinned when inferring on a GPU), fill it through its numpy view
+    pin_memory = self.inference_brain()[1].type == "cuda"
+    return torch.zeros((batch_size,) + tuple(self.brain.input_shape), dtype=dtype, pin_memory=pin_memory)
+
+  def predict_batch(self, x, legal_mask=None):
+    '''
+      x - N x 2 x board_len x board_len contiguous float32 or int8 numpy array or tensor of prepared states
+      legal_mask - (optional) N x board_len x board_len boolean mask of moves allowed in each state,
+        defaults to the empty cells
+
+      returns N x board_len x board_len policies renormalized over legal moves and N values as numpy arrays
+    '''
+    brain, device = self.inference_brain()
+
+    with torch.inference_mode():
+      x = torch.from_numpy(x) if isinstance(x, np.ndarray) else x
+      x = x.to(device, non_blocking=True).float()
+
+      if legal_mask is None:
+        legal_mask = (x[:, 0] + x[:, 1]) == 0
+      else:
+        legal_mask = torch.from_numpy(legal_mask) if isinstance(legal_mask, np.ndarray) else legal_mask
+        legal_mask = legal_mask.to(device, non_blocking=True)
+
+      policy, value = self.run_brain(brain, device, x)
+      policy = policy.view(legal_mask.shape) * legal_mask
+      policy /= policy.sum(dim=(1, 2), keepdim=True).clamp(min=1e-12)
+
+      return policy.cpu().numpy(), value.view(-1).cpu().numpy()
+
+  def predict(self, x, interpret_output=True, legal_mask=None):
+    # legal_mask - (optional) board_len x board_len mask the interpreted policy is restricted to and re-normalized over
     if len(x.shape) < 4:
       x = np.expand_dims(x, axis=0)
 
-    x = torch.from_numpy(x).float().to(self.device)
+    x = torch.from_numpy(x) if isinstance(x, np.ndarray) else x
+    x = x.float().to(self.device, non_blocking=True)
 
-    policy, value = self.brain(x)
+    if self.brain.training:
+      policy, value = self.run_brain(self.brain, self.device, x)
+    else:
+      brain, device = self.inference_brain()
+      with torch.inference_mode():
+        policy, value = self.run_brain(brain, device, x.to(device))
 
     if interpret_output: # return 2d policy map and value in usable form
-      policy = policy.view(-1, self.args["board_len"], self.args["board_len"])
-      policy = policy[0].cpu().detach().numpy()
+      policy = policy.view(-1, self.args["board_len"], self.args["board_len"])[0]
+      if legal_mask is not None:
+        policy = policy * torch.from_numpy(legal_mask).to(policy.device)
+        policy /= policy.sum().clamp(min=1e-12)
+      policy = policy.cpu().detach().numpy()
       value = value[0][0].item()
     return policy, value
@@ -0,0 +1,100 @@
+import os
+import sys
+import random
+import numpy as np
+import multiprocessing as mp
+from copy import deepcopy
+
+import torch
+
+sys.path.append(os.path.join(os.environ["HOME"], "TTTArena"))
+
+from alphazero.mcts import MCTS, visits_to_pi
+
+def search_worker(model, root_state, args, seed, conn):
+  # One tree per process, driven by the ParallelMCTS that owns the other end of conn
+  torch.set_num_threads(1)
+  np.random.seed(seed)
+  random.seed(seed)
+
+  mcts = MCTS(model, root_state, args)
+  while True:
+    command, payload = conn.recv()
+    if command == "search":
+      mcts.search(payload)
+      conn.send(mcts.get_pi(as_prob=False))
+    elif command == "move":
+      mcts.select_move(external_move=payload)
+    elif command == "close":
+      break
+  conn.close()
+
+class ParallelMCTS():
+  def __init__(self, model, root_state, args, metrics=None):
+    '''
+      Root-parallel MCTS with the same interface as MCTS
+
+      Every worker process grows its own tree from the same root (with its own dirichlet noise) and the root
+      visit counts of all trees are summed when a move is picked. The trees persist between moves like in MCTS.
+
+      model - class with predict method that returns a valid policy and value
+      root_state - board_len x board_len array with the initial state of the game
+      metrics - (optional) Metrics that counts simulations
+
+      args:
+        same as MCTS, num_simulations is split between the workers
+        num_workers - number of search processes
+    '''
+    self.root = deepcopy(root_state)
+    self.args = args
+    self.metrics = metrics
+    self.visits = np.zeros(self.root.shape)
+
+    num_workers = self.args["num_workers"]
+    worker_args = dict(self.args, num_simulations=max(1, self.args["num_simulations"] // num_workers))
+
+    ctx = mp.get_context("fork")
+    self.conns, self.processes = [], []
+    for nr in range(num_workers):
+      conn, worker_conn = ctx.Pipe()
+      proc = ctx.Process(target=search_worker, args=(model, self.root, worker_args, np.random.randint(2**31), worker_conn), daemon=True)
+      proc.start()
+      self.conns.append(conn)
+      self.processes.append(proc)
+
+  def search(self, num_simulations=None):
+    num_simulations = num_simulations or self.args["num_simulations"]
+    for conn in self.conns:
+      conn.send(("search", max(1, num_simulations // len(self.conns))))
+    self.visits = sum(conn.recv() for conn in self.conns)
+    if self.metrics is not None:
+      self.metrics.count("simulations", num_simulations)
+
+  def get_pi(self, tau=1.0, as_prob=True):
+    move_dist = np.array(self.visits, dtype=float)
+    if as_prob is True:
+      move_dist = visits_to_pi(move_dist, tau)
+    return move_dist
+
+  def select_move(self, tau=1.0, external_move=None):
+    if external_move is None:
+      probas = self.get_pi(tau)
+      selected_move = int(np.random.choice(len(probas.flatten()), p=probas.flatten()))
+      selected_move = np.unravel_index(selected_move, probas.shape)
+    else:
+      selected_move = external_move
+
+    for conn in self.conns:
+      conn.send(("move", selected_move))
+    self.root[selected_move] = 1
+    self.root *= -1
+    self.visits = np.zeros(self.root.shape)
+
+    return selected_move
+
+  def close(self):
+    for conn in self.conns:
+      conn.send(("close", None))
+    for proc in self.processes:
+      proc.join()
+    self.conns, self.processes = [], []
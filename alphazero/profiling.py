@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+from collections import defaultdict
+
+# Functions wrapped by the timers, as (module names the class/function may be imported under, class name or None, attribute)
+profiled_functions = [
+  (["mcts", "alphazero.mcts"], "MCTS", "find_leaf"),
+  (["mcts", "alphazero.mcts"], None, "prepare_state"),
+  (["database", "alphazero.database"], None, "prepare_state"),
+  (["environment"], "Environment", "game_over"),
+  (["model", "alphazero.model"], "ZeroTTT", "predict")
+]
+
+active_profiler = None
+
+class Profiler:
+  def __init__(self, mode="timers", out_dir="./profiles"):
+    '''
+      Opt-in profiling of the search hot paths, nothing is wrapped unless a profiler is created
+
+      mode:
+        timers - wall-clock timers and call counters around MCTS.find_leaf, Environment.game_over, prepare_state and
+          ZeroTTT.predict, dumped as collapsed stacks (flamegraph.pl / speedscope compatible)
+        cprofile - cProfile of every profiled move, dumped as pstats
+      out_dir - directory the profiles are dumped into
+    '''
+    self.mode = mode
+    self.out_dir = out_dir
+
+    self.stack = [] # [name, start time, time spent in children] of the wrapped calls in progress
+    self.collapsed = defaultdict(float) # "outer;...;inner" -> self time in seconds
+    self.calls = defaultdict(int)
+    self.totals = defaultdict(float)
+    self.move_times = []
+
+    self.cprofile = cProfile.Profile() if mode == "cprofile" else None
+
+    if mode == "timers":
+      self.install()
+
+  def install(self):
+    for module_names, cls_name, attr in profiled_functions:
+      name = attr if cls_name is None else f"{cls_name}.{attr}"
+      for module_name in module_names:
+        module = sys.modules.get(module_name)
+        if module is None:
+          continue
+        owner = module if cls_name is None else getattr(module, cls_name)
+        fn = getattr(owner, attr)
+        if getattr(fn, "profiled", False):
+          continue
+        if isinstance(owner.__dict__.get(attr), staticmethod):
+          setattr(owner, attr, staticmethod(self.wrap(name, fn)))
+        else:
+          setattr(owner, attr, self.wrap(name, fn))
+
+  def enter(self, name):
+    self.stack.append([name, time.perf_counter(), 0.0])
+
+  def exit(self):
+    name, start, child_time = self.stack.pop()
+    total = time.perf_counter() - start
+    self.collapsed[";".join([frame[0] for frame in self.stack] + [name])] += total - child_time
+    self.calls[name] += 1
+    if self.stack:
+      self.stack[-1][2] += total
+    if name not in [frame[0] for frame in self.stack]: # don't count recursive calls twice
+      self.totals[name] += total
+    return total
+
+  def wrap(self, name, fn):
+    def wrapped(*args, **kwargs):
+      self.enter(name)
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        self.exit()
+    wrapped.profiled = True
+    wrapped.__wrapped__ = fn
+    return wrapped
+
+  def wrap_move(self, fn, name):
+    # Root frame of one move, its latency is recorded separately
+    def wrapped(*args, **kwargs):
+      if self.cprofile is not None:
+        self.cprofile.enable()
+      self.enter(name)
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        self.move_times.append(self.exit())
+        if self.cprofile is not None:
+          self.cprofile.disable()
+    return wrapped
+
+  def dump(self, tag):
+    if len(self.move_times) == 0:
+      return
+    os.makedirs(self.out_dir, exist_ok=True)
+    path = os.path.join(self.out_dir, tag)
+
+    if self.cprofile is not None:
+      self.cprofile.dump_stats(path + ".prof")
+      pstats.Stats(path + ".prof").sort_stats("cumulative").print_stats(15)
+      self.cprofile = cProfile.Profile()
+    else:
+      with open(path + ".collapsed", "w") as f:
+        for stack, seconds in sorted(self.collapsed.items()):
+          f.write(f"{stack} {int(1e6 * seconds)}\n") # microseconds as sample counts
+
+    print(f"Profiled {len(self.move_times)} moves, {1000 * sum(self.move_times) / len(self.move_times):.1f} ms per move:")
+    for name in sorted(self.totals, key=lambda name: -self.totals[name]):
+      print(f"  {name}: {self.calls[name]} calls, {self.totals[name]:.3f} s")
+
+    self.collapsed.clear()
+    self.calls.clear()
+    self.totals.clear()
+    self.move_times = []
+
+def get_profiler(mode=None, out_dir=None):
+  '''
+    Process-wide profiler if profiling is turned on by mode or the ALPHAZERO_PROFILE environment variable
+    (timers or cprofile, ALPHAZERO_PROFILE_DIR sets the output directory), None otherwise
+  '''
+  global active_profiler
+  mode = mode if mode is not None else os.environ.get("ALPHAZERO_PROFILE")
+  if not mode:
+    return None
+  if active_profiler is None:
+    active_profiler = Profiler(mode, out_dir or os.environ.get("ALPHAZERO_PROFILE_DIR", "./profiles"))
+  return active_profiler
@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from copy import deepcopy
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+sys.path.append(os.path.join(os.environ["HOME"], "TTTArena"))
+
+from alphazero.database import prepare_state, chunk_numbers
+
+def load_calibration_states(buffer_path, chunk_nums=None, max_positions=2048):
+  # Prepared states from replay chunks written by DataBase.save_data
+  states_dir = os.path.join(buffer_path, "states")
+  if chunk_nums is None:
+    chunk_nums = chunk_numbers(buffer_path)
+
+  states = []
+  for chunk_num in chunk_nums:
+    states.append(np.load(os.path.join(states_dir, f"state_chunk_{chunk_num}.npy")))
+    if sum(len(chunk) for chunk in states) >= max_positions:
+      break
+  return np.concatenate(states)[:max_positions].astype(np.float32)
+
+def random_calibration_states(board_len, count=512, max_stones=40, seed=80085):
+  # Fallback for when there is no replay buffer around, random positions with up to max_stones stones
+  rng = np.random.default_rng(seed)
+  states = []
+  for _ in range(count):
+    board = np.zeros(board_len*board_len)
+    cells = rng.choice(board_len*board_len, rng.integers(0, max_stones), replace=False)
+    board[cells[::2]] = 1
+    board[cells[1::2]] = -1
+    states.append(prepare_state(board.reshape(board_len, board_len)))
+  return np.array(states, dtype=np.float32)
+
+def default_backend():
+  # Quantized engine torch already picked for this host (x86 on Intel/AMD, qnnpack on ARM), else the first supported one
+  if torch.backends.quantized.engine != "none":
+    return torch.backends.quantized.engine
+  for backend in ("x86", "fbgemm", "qnnpack", "onednn"):
+    if backend in torch.backends.quantized.supported_engines:
+      return backend
+  raise RuntimeError("No quantized engine is supported on this host")
+
+def quantize_brain(brain, calibration_states, batch_size=64, backend=None):
+  '''
+    Post-training static int8 quantization of the conv layers of a Brain (CPU only)
+
+    brain - float Brain, left untouched
+    calibration_states - N x 2 x board_len x board_len array of prepared states
+    backend - (optional) quantized engine, by default the one in use on this host, which is then left as it is
+      (the quantized brain runs on the engine it was converted for, so another backend becomes the process-wide engine)
+  '''
+  backend = backend if backend is not None else default_backend()
+  if torch.backends.quantized.engine != backend:
+    torch.backends.quantized.engine = backend
+  brain = deepcopy(brain).cpu().eval()
+
+  # Value head's linear layer and the heads' output nonlinearities stay in float
+  qconfig_mapping = get_default_qconfig_mapping(backend).set_module_name("value_head.val_linear1", None)
+  example = torch.from_numpy(calibration_states[:1])
+  prepared = prepare_fx(brain, qconfig_mapping, (example,))
+
+  with torch.inference_mode():
+    for i in range(0, len(calibration_states), batch_size):
+      prepared(torch.from_numpy(calibration_states[i : i + batch_size]))
+
+  return convert_fx(prepared)
+
+def time_brain(brain, states, batch_size, repeats=50):
+  batch = torch.from_numpy(states[:batch_size])
+  with torch.inference_mode():
+    brain(batch) # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+      brain(batch)
+  return (time.perf_counter() - start) / repeats
+
+def compare_brains(float_brain, quantized_brain, states, batch_sizes=(1, 64)):
+  # Accuracy vs speed of the quantized brain measured against the float one
+  float_brain = float_brain.cpu().eval()
+  x = torch.from_numpy(states)
+  with torch.inference_mode():
+    p, v = float_brain(x)
+    qp, qv = quantized_brain(x)
+
+  report = {
+    "positions": len(states),
+    "policy_top1_agreement": (p.argmax(dim=1) == qp.argmax(dim=1)).float().mean().item(),
+    "policy_kl": (p * (torch.log(p + 1e-8) - torch.log(qp + 1e-8))).sum(dim=1).mean().item(),
+    "value_mae": (v - qv).abs().mean().item()
+  }
+  for batch_size in batch_sizes:
+    float_time = time_brain(float_brain, states, batch_size)
+    quantized_time = time_brain(quantized_brain, states, batch_size)
+    report[f"float_ms_batch_{batch_size}"] = 1000 * float_time
+    report[f"int8_ms_batch_{batch_size}"] = 1000 * quantized_time
+    report[f"speedup_batch_{batch_size}"] = float_time / quantized_time
+  return report
+
+def get_arg_parser():
+  parser = argparse.ArgumentParser(description="Accuracy vs speed report of the int8 quantized brain against the float one")
+  parser.add_argument("model_name", type=str, help="Name of model stored in TTTArena/alphazero/models")
+  parser.add_argument("--buffer_path", type=str, default=None, help="Replay buffer used for calibration and evaluation")
+  parser.add_argument("--board_len", type=int, default=10)
+  parser.add_argument("--positions", type=int, default=2048)
+  return parser
+
+def main():
+  from alphazero.model import ZeroTTT
+
+  args = get_arg_parser().parse_args()
+  model = ZeroTTT(args.model_name, None, {"board_len": args.board_len, "lr": 3e-4, "weight_decay": 1e-4})
+
+  if args.buffer_path is not None:
+    states = load_calibration_states(args.buffer_path, max_positions=args.positions)
+  else:
+    states = random_calibration_states(args.board_len, count=args.positions)
+
+  # Calibrate on one half, evaluate on the other
+  calibration, evaluation = states[: len(states)//2], states[len(states)//2 :]
+  quantized_brain = quantize_brain(model.brain, calibration)
+
+  for key, value in compare_brains(model.brain, quantized_brain, evaluation).items():
+    print(f"{key}: {value}")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,142 @@
+import os
+import numpy as np
+
+from database import read_manifest
+
+class ReplayWindow:
+  def __init__(self, path, window=5, recency=1.0):
+    '''
+      Minibatch sampler over the replay chunks (DataBase.save_data) of the last window model generations
+
+      Chunks are memory mapped as they show up in the manifest and dropped once their generation leaves the
+      window, so training can keep running while self-play adds chunks.
+
+      path - replay buffer directory
+      window - number of most recent generations sampled from
+      recency - weight of a position relative to one from the next generation, 1.0 samples the window uniformly
+    '''
+    self.path = path
+    self.window = window
+    self.recency = recency
+
+    self.chunks = {} # chunk number -> (manifest entry, states, policy labels, value labels)
+    self.chunk_nums = [] # keys of self.chunks in the order of self.weights
+    self.weights = np.zeros(0) # sampling probability of every chunk in self.chunks
+    self.refresh()
+
+  def refresh(self):
+    # Picks up new chunks from the manifest, returns the number of positions in the window
+    entries = read_manifest(self.path)["chunks"]
+    if len(entries) == 0:
+      return 0
+
+    latest = max(entry["generation"] for entry in entries)
+    in_window = {entry["chunk"]: entry for entry in entries if entry["generation"] > latest - self.window}
+
+    for chunk_num in list(self.chunks):
+      if chunk_num not in in_window:
+        del self.chunks[chunk_num]
+    for chunk_num, entry in in_window.items():
+      if chunk_num not in self.chunks:
+        self.chunks[chunk_num] = (entry,
+          np.load(os.path.join(self.path, "states", f"state_chunk_{chunk_num}.npy"), mmap_mode="r"),
+          np.load(os.path.join(self.path, "policy_labels", f"policy_chunk_{chunk_num}.npy"), mmap_mode="r"),
+          np.load(os.path.join(self.path, "value_labels", f"value_chunk_{chunk_num}.npy"), mmap_mode="r"))
+
+    self.chunk_nums = list(self.chunks)
+    weights = np.array([entry["positions"] * self.recency**(latest - entry["generation"]) for entry, *_ in self.chunks.values()])
+    self.weights = weights / weights.sum()
+    return sum(entry["positions"] for entry, *_ in self.chunks.values())
+
+  def sample(self, batch_size):
+    if len(self.chunk_nums) == 0:
+      raise RuntimeError(f"No replay chunks in {self.path} yet")
+    # Chunks are drawn by weight and positions uniformly within a chunk, returns states, policy labels and value labels
+    picks = np.random.choice(len(self.chunk_nums), size=batch_size, p=self.weights)
+    states, policy_labels, value_labels = [], [], []
+    for c, count in zip(*np.unique(picks, return_counts=True)):
+      entry, chunk_states, chunk_policies, chunk_values = self.chunks[self.chunk_nums[c]]
+      idx = np.sort(np.random.randint(entry["positions"], size=count)) # sorted for sequential memmap reads
+      states.append(chunk_states[idx])
+      policy_labels.append(chunk_policies[idx])
+      value_labels.append(chunk_values[idx])
+
+    perm = np.random.permutation(batch_size)
+    return np.concatenate(states)[perm], np.concatenate(policy_labels)[perm], np.concatenate(value_labels)[perm]
+
+class SumTree:
+  def __init__(self, capacity):
+    # Binary tree of priority sums over capacity leaves, stored as an array with the root at 1
+    self.capacity = 1
+    while self.capacity < capacity:
+      self.capacity *= 2
+    self.tree = np.zeros(2*self.capacity)
+
+  def total(self):
+    return self.tree[1]
+
+  def update(self, idx, priorities):
+    nodes = np.asarray(idx) + self.capacity
+    self.tree[nodes] = priorities
+    while nodes[0] > 1:
+      nodes = np.unique(nodes // 2)
+      self.tree[nodes] = self.tree[2*nodes] + self.tree[2*nodes + 1]
+
+  def find(self, prefix_sums):
+    # Leaves the prefix sums fall into, all of them descended at once
+    nodes = np.ones(len(prefix_sums), dtype=np.int64)
+    prefix_sums = np.array(prefix_sums, dtype=float)
+    while nodes[0] < self.capacity:
+      left = 2*nodes
+      go_right = prefix_sums >= self.tree[left]
+      prefix_sums -= np.where(go_right, self.tree[left], 0.0)
+      nodes = left + go_right
+    return nodes - self.capacity
+
+class PrioritizedReplay:
+  def __init__(self, states, policy_labels, value_labels, alpha=0.6, beta=0.4, eps=1e-3):
+    '''
+      Prioritized experience replay over the positions of a DataBase (prepared states and labels as arrays)
+
+      Positions are sampled with probability p_i^alpha / sum p^alpha, where p_i is the last training loss of the
+      position (plus eps). Positions that haven't been trained on yet have the largest priority so far, so they're
+      sampled before the ones with known losses.
+
+      alpha - how much the priorities matter, 0.0 is uniform sampling
+      beta - importance sampling exponent, 1.0 fully corrects for the non-uniform sampling
+      eps - keeps positions with no loss sampleable
+    '''
+    self.states = states
+    self.policy_labels = policy_labels
+    self.value_labels = value_labels
+    self.alpha = alpha
+    self.beta = beta
+    self.eps = eps
+
+    self.size = len(states)
+    self.tree = SumTree(self.size)
+    self.max_priority = 1.0
+    self.untrained = np.ones(self.size, dtype=bool)
+    self.tree.update(np.arange(self.size), np.full(self.size, self.max_priority))
+
+  def sample(self, batch_size):
+    # Stratified over batch_size equal segments of the priority mass, returns indices, batch and importance sampling weights
+    segment = self.tree.total() / batch_size
+    idx = self.tree.find(segment * (np.arange(batch_size) + np.random.random(batch_size)))
+    idx = np.minimum(idx, self.size - 1)
+
+    probs = self.tree.tree[idx + self.tree.capacity] / self.tree.total()
+    weights = (self.size * probs)**(-self.beta)
+    weights /= weights.max()
+    return idx, self.states[idx], self.policy_labels[idx], self.value_labels[idx], weights.astype(np.float32)
+
+  def update(self, idx, losses):
+    priorities = (np.asarray(losses) + self.eps)**self.alpha
+    self.tree.update(idx, priorities)
+    self.untrained[idx] = False
+
+    if priorities.max() > self.max_priority:
+      self.max_priority = priorities.max()
+      untrained = np.flatnonzero(self.untrained)
+      if len(untrained) > 0:
+        self.tree.update(untrained, np.full(len(untrained), self.max_priority))
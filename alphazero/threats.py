@@ -0,0 +1,145 @@
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.environ["HOME"], "TTTArena"))
+
+from environment import Environment
+
+def five_points(board, player, windows):
+  # Empty cells that complete a line of 5 for player, board is flattened
+  lines = board[windows]
+  empty = (lines == 0)
+  hits = ((lines == player).sum(axis=1) == 4) & (empty.sum(axis=1) == 1)
+  return np.unique(windows[hits][empty[hits]])
+
+def four_moves(board, player, windows):
+  # Empty cells that give player a four (a line of 5 missing one stone), board is flattened
+  lines = board[windows]
+  empty = (lines == 0)
+  hits = ((lines == player).sum(axis=1) == 3) & (empty.sum(axis=1) == 2)
+  return np.unique(windows[hits][empty[hits]])
+
+class ThreatSolver:
+  def __init__(self, board_len, budget=100):
+    '''
+      Threat-space search for forced wins by continuous fours (VCF)
+
+      board_len - # of rows and columns on board
+      budget - maximum number of four moves tried per solve
+    '''
+    self.board_len = board_len
+    self.budget = budget
+    self.windows = Environment.five_windows(board_len)
+    self.nodes = 0
+
+  def solve(self, state):
+    '''
+      state - board_len x board_len board from the perspective of the player to move (their stones are 1)
+
+      returns:
+        (1, move) - proven win for the player to move, by a five or a VCF starting with move
+        (-1, None) - proven loss, the opponent has two ways to complete a five and the player to move has none
+        (0, move) - move is forced, it blocks the opponent's only way to complete a five
+        (None, None) - nothing proven
+    '''
+    board = state.flatten().astype(np.int8)
+
+    own = five_points(board, 1, self.windows)
+    if len(own) > 0:
+      return 1, self.to_move(own[0])
+
+    theirs = five_points(board, -1, self.windows)
+    if len(theirs) > 1:
+      return -1, None
+    if len(theirs) == 1:
+      return 0, self.to_move(theirs[0])
+
+    self.nodes = 0
+    cell = self.vcf(board)
+    if cell is not None:
+      return 1, self.to_move(cell)
+    return None, None
+
+  def vcf(self, board):
+    # Neither side can complete a five on board, returns the first four of a winning VCF or None
+    for cell in four_moves(board, 1, self.windows).tolist():
+      self.nodes += 1
+      if self.nodes > self.budget:
+        return None
+
+      board[cell] = 1
+      fives = five_points(board, 1, self.windows)
+      won = len(fives) > 1 # open four or double four
+      if len(fives) == 1:
+        # The opponent has to block, unless blocking gives them a four (not followed to keep the search small)
+        board[fives[0]] = -1
+        won = len(five_points(board, -1, self.windows)) == 0 and self.vcf(board) is not None
+        board[fives[0]] = 0
+      board[cell] = 0
+
+      if won:
+        return cell
+    return None
+
+  def to_move(self, cell):
+    return (int(cell) // self.board_len, int(cell) % self.board_len)
+
+class PatternTable:
+  def __init__(self, state):
+    '''
+      Stone counts of both players on every line of 5 cells (Environment.five_windows), seen from the perspective
+      of the player to move and updated incrementally as moves are played and undone
+
+      state - board_len x board_len board from the perspective of the player to move (their stones are 1)
+    '''
+    board_len = len(state)
+    self.windows = Environment.five_windows(board_len)
+
+    cell_windows = [[] for _ in range(board_len*board_len)]
+    for w, cells in enumerate(self.windows.tolist()):
+      for cell in cells:
+        cell_windows[cell].append(w)
+    self.cell_windows = [np.array(ws, dtype=np.int64) for ws in cell_windows]
+
+    lines = state.ravel()[self.windows]
+    self.mine = (lines == 1).sum(axis=1)
+    self.theirs = (lines == -1).sum(axis=1)
+    self.empty = int((state == 0).sum())
+    self.history = [] # cells played since the table was built
+
+  def play(self, cell):
+    # The player to move plays at (flat index) cell and the perspective swaps
+    self.mine[self.cell_windows[cell]] += 1
+    self.mine, self.theirs = self.theirs, self.mine
+    self.empty -= 1
+    self.history.append(cell)
+
+  def undo(self, cell):
+    self.mine, self.theirs = self.theirs, self.mine
+    self.mine[self.cell_windows[cell]] -= 1
+    self.empty += 1
+    self.history.pop()
+
+  def terminal(self):
+    # Environment.game_over of the current position, only the lines through the last move can hold a new five
+    if len(self.history) == 0: # the position the table was built from
+      if (self.mine == 5).any():
+        return 1
+      if (self.theirs == 5).any():
+        return -1
+    elif (self.theirs[self.cell_windows[self.history[-1]]] == 5).any():
+      return -1
+    return 0 if self.empty == 0 else 10
+
+  def completing_cells(self, state, own, other):
+    lines = self.windows[(own == 4) & (other == 0)]
+    return np.unique(lines[state.ravel()[lines] == 0])
+
+  def wins(self, state):
+    # Cells where the player to move completes a five
+    return self.completing_cells(state, self.mine, self.theirs)
+
+  def threats(self, state):
+    # Cells where the opponent would complete a five
+    return self.completing_cells(state, self.theirs, self.mine)
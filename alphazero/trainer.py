@@ -1,28 +1,95 @@
 import os
 import sys
+import time
 import torch
+import numpy as np
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
 
 sys.path.append(os.path.join(os.environ["HOME"], "TTTArena"))
 
 from mcts import MCTS
-from database import DataBase
+from metrics import Metrics
+from profiling import get_profiler
+from database import DataBase, ChunkWriter, prepare_state_into
+from replay import PrioritizedReplay
 from environment import Environment
 
+class SelfPlayGame:
+  def __init__(self, trainer):
+    '''
+      One of the games Trainer.generate_batched advances together, it plays the same way as Trainer.generate_game
+      but the simulations of its searches are driven from outside and its positions are kept until the game ends
+    '''
+    self.trainer = trainer
+    self.env = Environment(board_len=trainer.args["board_len"])
+    self.mcts = MCTS(trainer.model, self.env.board, trainer.args["mcts_args"], trainer.metrics)
+
+    self.tau = 1.0
+    self.game_state = 10
+    self.positions = [] # recorded (state, policy target) pairs
+    self.recorded_plies = []
+    self.start_search()
+
+  def start_search(self):
+    args = self.trainer.args
+    num_simulations = args["mcts_args"]["num_simulations"]
+    self.full_search = np.random.random() < args.get("full_search_prob", 1.0)
+    self.simulations_left = num_simulations if self.full_search else args.get("fast_simulations", max(1, num_simulations // 6))
+
+  def end_simulation(self):
+    # Plays a move once the search is done, returns True when the game is over
+    self.simulations_left -= 1
+    if self.simulations_left > 0:
+      return False
+
+    if len(self.env.move_hist) > 30: # argmax after 30 moves
+      self.tau = 0.01
+    if self.full_search:
+      self.positions.append((((-1)**(self.env.turn == -1))*self.env.board, self.mcts.policy_target()))
+      self.recorded_plies.append(len(self.env.move_hist))
+
+    move = self.mcts.select_move(tau=self.tau)
+    memory = self.mcts.memory_stats()
+    self.trainer.metrics.sample("tree_nodes", memory["nodes"])
+    self.trainer.metrics.sample("tree_bytes", memory["bytes"])
+    self.game_state = self.env.step(move)
+    if self.game_state != 10:
+      return True
+    self.start_search()
+    return False
+
 class Trainer:
-  def __init__(self, model, args):
+  def __init__(self, model, args, metrics=None):
     '''
       model - trainable class with predict method that returns a valid policy and value
+      metrics - (optional) Metrics the self-play throughput is recorded in
       
       args : 
         mcts_args - dict containing mcts args
         db_args - dict containing database args
 
         board_len - # of rows and columns on board
+        generation - (optional) generation of the model, recorded with the replay chunks it generates (default 0)
+        full_search_prob - (optional) playout cap randomization, only this fraction of moves get the full
+          num_simulations search and are recorded, the rest get a fast search (default 1.0, every move)
+        fast_simulations - (optional) number of simulations of the fast searches (default num_simulations // 6)
+        async_save - (optional) save replay chunks from a background thread (default True)
+        parallel_games - (optional) number of games generate_buffer plays at once with batched network evaluations
+          (default 1, one game at a time with generate_game)
+        prioritized - (optional) dict of PrioritizedReplay args (alpha, beta, eps), train samples positions by their
+          last loss instead of going over shuffled batches, beta is annealed to 1.0 over the training steps
+        loader - (optional) dict with num_workers (default 2), prefetch_factor (default 4) and augment (default True),
+          train feeds the batches through a torch DataLoader with worker processes and on-the-fly augmentation,
+          which only applies when db_args augmentations is empty (use that to store 1x instead of 8x positions)
+        profile - (optional) profiling mode (timers or cprofile), also turned on by ALPHAZERO_PROFILE
     '''
 
     self.args = args
     self.model = model
     self.database = DataBase(self.args["db_args"])
+    self.metrics = metrics if metrics is not None else Metrics()
+    self.profiler = get_profiler(self.args.get("profile"))
+    self.writer = None # ChunkWriter of generate_buffer
 
   def generate_game(self, render=False):
     self.model.brain.eval()
@@ -30,59 +97,219 @@ class Trainer:
 
     tau = 1.0
     game_state = 10
-    mcts = MCTS(self.model, env.board, self.args["mcts_args"])
+    recorded_plies = []
+    full_search_prob = self.args.get("full_search_prob", 1.0)
+    fast_simulations = self.args.get("fast_simulations", max(1, self.args["mcts_args"]["num_simulations"] // 6))
+    mcts = MCTS(self.model, env.board, self.args["mcts_args"], self.metrics)
+    if self.profiler is not None:
+      mcts.search = self.profiler.wrap_move(mcts.search, "MCTS.search")
 
     while game_state == 10:
       if len(env.move_hist) > 30: # argmax after 30 moves
         tau = 0.01
 
-      mcts.search()
-      self.database.append_policy(((-1)**(env.turn == -1))*env.board, mcts.get_pi())
+      full_search = np.random.random() < full_search_prob
+      with self.metrics.timer("search"):
+        mcts.search(None if full_search else fast_simulations)
+      if full_search: # only full searches give policy targets
+        self.database.append_policy(((-1)**(env.turn == -1))*env.board, mcts.policy_target())
+        recorded_plies.append(len(env.move_hist))
 
       move = mcts.select_move(tau=tau)
+      memory = mcts.memory_stats()
+      self.metrics.sample("tree_nodes", memory["nodes"])
+      self.metrics.sample("tree_bytes", memory["bytes"])
       game_state = env.step(move)
 
       if render:
         env.render()
 
-    self.database.append_value(game_state, len(env.move_hist))
+    self.finish_game(game_state, len(env.move_hist), recorded_plies)
+
+  def finish_game(self, game_state, game_length, recorded_plies):
+    self.database.append_value(game_state, game_length, recorded_plies)
+
+    self.metrics.count("games")
+    self.metrics.count("moves", game_length)
+    record = self.metrics.flush()
+    if self.profiler is not None:
+      self.profiler.dump(f"worker_{self.metrics.worker_id}_game_{self.metrics.counters['games']}")
+
+    print(f"Player with token: {game_state} won the game in {game_length} moves ({record['simulations_per_sec']:.1f} simulations/sec)")
+
+  def generate_batched(self, buffer_path, num_games):
+    '''
+      Self-play of num_games games at once, every simulation step selects one leaf in each game and evaluates the
+      new leaves of all games in one predict_batch call. Finished games are written to the DataBase in one piece
+      (so the chunks look like the ones of generate_game) and replaced by new games.
+    '''
+    self.model.brain.eval()
+    games = [SelfPlayGame(self) for _ in range(num_games)]
+    batch = self.model.allocate_batch(num_games)
+    batch_np = batch.numpy()
+    masks = np.zeros((num_games, self.args["board_len"], self.args["board_len"]), dtype=bool)
+
+    while True:
+      with self.metrics.timer("search"):
+        leaves = [game.mcts.select_leaf() for game in games]
+        pending = [j for j, leaf in enumerate(leaves) if leaf.mask is not None]
+        if len(pending) > 0:
+          for row, j in enumerate(pending):
+            prepare_state_into(leaves[j].state, batch_np[row])
+            masks[row] = leaves[j].mask
+          self.metrics.count("nn_evals", len(pending))
+          with self.metrics.timer("inference"):
+            policies, values = self.model.predict_batch(batch[:len(pending)], masks[:len(pending)])
+          for row, j in enumerate(pending):
+            games[j].mcts.expand_finish(leaves[j].node, leaves[j].mask, policies[row], float(values[row]))
+
+        for game, leaf in zip(games, leaves):
+          game.mcts.backup(leaf)
+      self.metrics.count("simulations", num_games)
 
-    print(f"Player with token: {game_state} won the game in {len(env.move_hist)} moves")
+      for j, game in enumerate(games):
+        if not game.end_simulation():
+          continue
+        for state, policy in game.positions:
+          self.database.append_policy(state, policy)
+        self.finish_game(game.game_state, len(game.env.move_hist), game.recorded_plies)
+        games[j] = SelfPlayGame(self)
+
+        if self.database.is_full():
+          self.save_buffer(buffer_path)
 
   def train(self, epochs, batch_size, save_id=""):
     print(f"Training on {len(self.database.states)} positions...")
     self.model.brain.train()
 
+    if self.args.get("prioritized") is not None:
+      return self.train_prioritized(epochs, batch_size, save_id)
+    if self.args.get("loader") is not None:
+      return self.train_loader(epochs, batch_size, save_id)
+
     batched_sts, batched_pls, batched_vls = self.database.prepare_batches(batch_size)
 
     for e in range(epochs):
       for j in range(len(batched_sts)):
-        self.model.optimizer.zero_grad()
+        self.train_step(batched_sts[j], batched_pls[j], batched_vls[j])
 
-        batch_st, batch_pl, batch_vl = batched_sts[j], batched_pls[j], batched_vls[j]
+    # Save after training step
+    self.model.save_brain(f'model_{save_id}', f'opt_state_{save_id}')
 
-        batch_pl = torch.from_numpy(batch_pl).to(self.model.device)
-        batch_vl = torch.from_numpy(batch_vl).float().to(self.model.device)
-        prob, val = self.model.predict(batch_st, interpret_output=False)
-        val = val.flatten()
+  def train_step(self, batch_st, batch_pl, batch_vl, weights=None):
+    '''
+      weights - (optional) importance sampling weights of the positions, the losses become weighted means of the
+        per position losses, which are returned
 
-        p_loss = self.model.policy_loss(prob, batch_pl)
-        v_loss = self.model.value_loss(val, batch_vl)
+      returns the loss, or the per position losses with weights
+    '''
+    self.model.optimizer.zero_grad()
 
-        loss = p_loss + v_loss
-        loss.backward()
+    batch_pl = torch.as_tensor(batch_pl).to(self.model.device, non_blocking=True)
+    batch_vl = torch.as_tensor(batch_vl).float().to(self.model.device, non_blocking=True)
+    prob, val = self.model.predict(batch_st, interpret_output=False)
+    val = val.flatten()
 
-        self.model.optimizer.step()
+    if weights is None:
+      p_loss = self.model.policy_loss(prob, batch_pl)
+      v_loss = self.model.value_loss(val, batch_vl)
+    else:
+      p_losses = -(batch_pl * torch.log(prob.clamp(min=1e-12))).sum(dim=1)
+      v_losses = (val - batch_vl)**2
+      weights = torch.from_numpy(weights).to(self.model.device)
+      p_loss = (weights * p_losses).mean()
+      v_loss = (weights * v_losses).mean()
+
+    loss = p_loss + v_loss
+    loss.backward()
+
+    self.model.optimizer.step()
+    if weights is None:
+      return loss.item()
+    return (p_losses + v_losses).detach().cpu().numpy()
+
+  def train_loader(self, epochs, batch_size, save_id=""):
+    # Batches are prepared and augmented by DataLoader workers while the previous steps run
+    loader_args = self.args["loader"]
+    dataset = self.database.dataset(loader_args.get("augment", True))
+    num_workers = loader_args.get("num_workers", 2)
+    loader = DataLoader(dataset, batch_size=None,
+      sampler=BatchSampler(RandomSampler(dataset), batch_size, drop_last=True),
+      num_workers=num_workers,
+      pin_memory=(self.model.device.type == "cuda"),
+      prefetch_factor=loader_args.get("prefetch_factor", 4) if num_workers > 0 else None,
+      persistent_workers=(num_workers > 0))
+
+    for e in range(epochs):
+      for batch_st, batch_pl, batch_vl in loader:
+        self.train_step(batch_st, batch_pl, batch_vl)
 
-    # Save after training step
     self.model.save_brain(f'model_{save_id}', f'opt_state_{save_id}')
 
+  def train_prioritized(self, epochs, batch_size, save_id=""):
+    # As many steps as train would take, on batches drawn by PrioritizedReplay
+    replay = PrioritizedReplay(*self.database.as_arrays(), **self.args["prioritized"])
+    steps = epochs * (replay.size // batch_size)
+    start_beta = replay.beta
+
+    for step in range(steps):
+      replay.beta = start_beta + (1.0 - start_beta) * step / max(steps - 1, 1)
+      idx, batch_st, batch_pl, batch_vl, weights = replay.sample(batch_size)
+      replay.update(idx, self.train_step(batch_st, batch_pl, batch_vl, weights))
+
+    self.model.save_brain(f'model_{save_id}', f'opt_state_{save_id}')
+
+  def train_replay(self, replay, steps, batch_size, save_id="", refresh_every=100, wait=30.0):
+    '''
+      Trains on minibatches sampled from a ReplayWindow instead of the positions in memory
+
+      replay - ReplayWindow over the replay buffer
+      refresh_every - # of steps between checks for new chunks in the manifest
+      wait - seconds between checks for the first chunk while the buffer is still empty
+    '''
+    positions = replay.refresh()
+    while positions == 0:
+      print(f"Waiting for replay chunks in {replay.path}...")
+      time.sleep(wait)
+      positions = replay.refresh()
+    print(f"Training on {positions} positions...")
+    self.model.brain.train()
+
+    for step in range(steps):
+      if step > 0 and step % refresh_every == 0:
+        replay.refresh()
+      self.train_step(*replay.sample(batch_size))
+
+    self.model.save_brain(f'model_{save_id}', f'opt_state_{save_id}')
+
+  def save_buffer(self, buffer_path):
+    # With async_save the io timer only measures how long self-play waited for the writer
+    positions = len(self.database.states)
+    with self.metrics.timer("io"):
+      if self.args.get("async_save", True):
+        if self.writer is None:
+          self.writer = ChunkWriter(buffer_path, self.args.get("generation", 0), self.database.dedup)
+        self.writer.check() # before taking the buffer so it's kept if the writer failed
+        self.writer.put(self.database.take_buffer())
+      else:
+        self.database.save_data(buffer_path, self.args.get("generation", 0))
+        self.database.clear()
+    self.metrics.count("positions_written", positions)
+
+  def close(self):
+    # Writes out the chunks still waiting in the ChunkWriter
+    if self.writer is not None:
+      writer, self.writer = self.writer, None
+      writer.close()
+
   def generate_buffer(self, buffer_path):
+    if self.args.get("parallel_games", 1) > 1 and not self.args["mcts_args"].get("gumbel"): # gumbel root search isn't batched
+      return self.generate_batched(buffer_path, self.args["parallel_games"])
+
     game_nr = 1
     while True:
       print(f"Game {game_nr}...")
       self.generate_game()
       if self.database.is_full():
-        self.database.save_data(buffer_path)
-        self.database.clear()
+        self.save_buffer(buffer_path)
       game_nr += 1
@@ -0,0 +1,145 @@
+import sys
+import numpy as np
+
+class Zobrist:
+  def __init__(self, board_len, seed=80085):
+    '''
+      Zobrist keys of a board_len x board_len board seen from the perspective of the player to move (their stones are 1)
+
+      Every position is tracked as a (key, flipped key) pair where the flipped key is the key of the negated board,
+      so a move (placing a 1 and negating the board, like MCTS does) is two xors and a swap.
+    '''
+    rng = np.random.default_rng(seed)
+    keys = rng.integers(1, 2**63, size=(2, board_len*board_len), dtype=np.int64)
+    self.board_len = board_len
+    self.mine = keys[0].tolist() # keys of stones of the player to move
+    self.theirs = keys[1].tolist()
+
+  def hash(self, state):
+    key, flipped = 0, 0
+    for cell in np.flatnonzero(state == 1).tolist():
+      key ^= self.mine[cell]
+      flipped ^= self.theirs[cell]
+    for cell in np.flatnonzero(state == -1).tolist():
+      key ^= self.theirs[cell]
+      flipped ^= self.mine[cell]
+    return key, flipped
+
+  def play(self, keys, cell):
+    # keys of the position after the player to move plays at (flat index) cell and the perspective swaps
+    key, flipped = keys
+    return flipped ^ self.theirs[cell], key ^ self.mine[cell]
+
+class Node:
+  __slots__ = ["key", "generation", "terminal", "value", "moves", "P", "N", "Q", "Ns"]
+
+  def __init__(self, key, generation, terminal):
+    self.key = key
+    self.generation = generation # search generation (root move) the node was last stored in
+    self.terminal = terminal # Environment.game_over of the node's state
+    self.value = 0.0 # network value at expansion
+
+    # Per child arrays, moves are flat indices into the board
+    self.moves = None # available actions
+    self.P = None # prior probabilities
+    self.N = None # visit counts
+    self.Q = None # Q values
+    self.Ns = 1 # visit count
+
+def node_bytes(node):
+  # Approximate memory held by a node and its child arrays
+  size = sys.getsizeof(node)
+  for array in (node.moves, node.P, node.N, node.Q):
+    if array is not None:
+      size += array.nbytes + 112 # ndarray header
+  return size
+
+class TranspositionTable:
+  def __init__(self, size_log2=18, max_bytes=None):
+    '''
+      Fixed-size table of search nodes indexed by the low bits of their Zobrist key
+
+      Replacement policy: a slot holding a different position is only taken over if its node is from an older
+      search generation (i.e. from before the root moved) or has been visited less than the incoming node, and
+      never if it holds the protected key (unless forced).
+
+      max_bytes - (optional) hard cap on the memory held by the nodes, the least visited nodes are evicted
+        when it is exceeded
+    '''
+    self.slots = [None] * (1 << size_log2)
+    self.slot_bytes = [0] * (1 << size_log2) # node_bytes of every node when it was stored (or resized)
+    self.mask = (1 << size_log2) - 1
+    self.generation = 0
+    self.max_bytes = max_bytes
+    self.protected_key = None # never replaced or evicted to make room (the root)
+
+    self.nodes = 0
+    self.bytes = 0
+    self.replaced = 0
+
+  def get(self, key):
+    node = self.slots[key & self.mask]
+    if node is not None and node.key == key:
+      if node.generation != self.generation:
+        node.generation = self.generation
+      return node
+    return None
+
+  def store(self, node, force=False):
+    index = node.key & self.mask
+    old = self.slots[index]
+    if old is not None and old.key != node.key:
+      if not force and (old.key == self.protected_key or (old.generation == self.generation and old.Ns > node.Ns)):
+        return False
+      self.replaced += 1
+    if old is not None:
+      self.evict(index)
+
+    self.slots[index] = node
+    self.slot_bytes[index] = node_bytes(node)
+    self.nodes += 1
+    self.bytes += self.slot_bytes[index]
+
+    if self.max_bytes is not None and self.bytes > self.max_bytes:
+      self.evict_least_visited()
+    return True
+
+  def evict(self, index):
+    self.nodes -= 1
+    self.bytes -= self.slot_bytes[index]
+    self.slots[index] = None
+    self.slot_bytes[index] = 0
+
+  def resize(self, node):
+    # Has to be called when the arrays of a stored node are replaced
+    index = node.key & self.mask
+    if self.slots[index] is node:
+      size = node_bytes(node)
+      self.bytes += size - self.slot_bytes[index]
+      self.slot_bytes[index] = size
+
+  def collect(self, reachable_keys):
+    # Evict every node that can't be reached from the current root anymore
+    for index, node in enumerate(self.slots):
+      if node is not None and node.key not in reachable_keys:
+        self.evict(index)
+
+  def evict_least_visited(self, fraction=0.9):
+    # Evict nodes from older generations first and the least visited ones within a generation
+    # until the nodes fit in fraction of max_bytes (so this doesn't run on every store)
+    candidates = sorted((node.generation, node.Ns, index) for index, node in enumerate(self.slots)
+      if node is not None and node.key != self.protected_key)
+    for _, _, index in candidates:
+      if self.bytes <= fraction * self.max_bytes:
+        break
+      self.evict(index)
+
+  def new_generation(self):
+    self.generation += 1
+
+  def clear(self):
+    self.slots = [None] * len(self.slots)
+    self.slot_bytes = [0] * len(self.slots)
+    self.nodes = 0
+    self.bytes = 0
+    self.replaced = 0
@@ -0,0 +1,224 @@
+# Benchmarks of the engine hot paths on fixed positions from data/30x30
+#
+# usage: python benchmarks/hot_paths.py [--model_name trained_model_3] [--out results.json] [--compare baseline.json]
+#
+# Results are written as JSON (by default to benchmarks/results/<commit>.json) so runs can be compared across commits.
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import importlib
+import subprocess
+import numpy as np
+
+sys.path.append(os.path.join(os.environ["HOME"], "TTTArena"))
+
+from environment import Environment
+
+from alphazero.mcts import MCTS
+from alphazero.model import ZeroTTT
+from alphazero.database import DataBase, prepare_state
+
+arena_path = os.path.join(os.environ["HOME"], "TTTArena")
+data_dir = os.path.join(arena_path, "data/30x30")
+
+mcts_args = {
+  "num_simulations": 100,
+  "alpha": 0.25,
+  "c_puct": 4,
+  "dirichlet_alpha": 0.3
+}
+
+def load_games():
+  # Games of data/30x30 in file name order, as arrays of (row, column) moves
+  names = sorted(os.listdir(data_dir), key=lambda name: int(name.split("_")[1]))
+  return [np.loadtxt(os.path.join(data_dir, name), delimiter=",", dtype=int).reshape(-1, 2) for name in names]
+
+def fit_game(game_hist, board_len):
+  # Shift a game into the top left corner of a board_len board, None if it doesn't fit
+  game_hist = game_hist - game_hist.min(axis=0)
+  if game_hist.max() >= board_len:
+    return None
+  return game_hist
+
+def replay(game_hist, board_len, plies=None):
+  env = Environment(board_len=board_len)
+  for move in game_hist[:plies]:
+    env.board[move[0]][move[1]] = env.turn
+    env.move_hist.append(tuple(move))
+    env.turn *= -1
+  return env
+
+def to_move_perspective(env):
+  return ((-1)**(env.turn == -1))*env.board
+
+def timeit(fn, repeats, setup=None):
+  # Per call wall-clock times in ms, setup (whose result is passed to fn) isn't timed
+  times = []
+  for _ in range(repeats):
+    arg = setup() if setup is not None else None
+    start = time.perf_counter()
+    fn(arg) if setup is not None else fn()
+    times.append(1000 * (time.perf_counter() - start))
+  times = np.array(times)
+  return {"mean_ms": float(times.mean()), "median_ms": float(np.median(times)), "min_ms": float(times.min()), "repeats": repeats}
+
+def fixtures():
+  all_games = load_games()
+  games = all_games[:20]
+  small_games = [game for game in (fit_game(game, 10) for game in all_games) if game is not None][:20]
+
+  return {
+    # mid-game and end-of-game boards, 30x30 for the environment and 10x10 for the alphazero agent
+    "boards_30": [replay(game, 30, len(game)//2).board for game in games] + [replay(game, 30).board for game in games],
+    "envs_30": [(game, len(game)//2) for game in games],
+    "boards_10": [to_move_perspective(replay(game, 10, len(game)//2)) for game in small_games],
+    "policies_10": [np.random.default_rng(i).dirichlet(np.ones(100)).reshape(10, 10) for i in range(len(small_games))]
+  }
+
+def bench_environment(fx, repeats):
+  results = {}
+  boards = fx["boards_30"]
+  results["Environment.game_over[30x30]"] = timeit(lambda: [Environment.game_over(board) for board in boards], repeats)
+  results["Environment.game_over[30x30]"]["positions"] = len(boards)
+
+  envs = fx["envs_30"]
+  def setup():
+    return [(replay(game, 30, ply), tuple(game[ply])) for game, ply in envs]
+  results["Environment.step[30x30]"] = timeit(lambda pairs: [env.step(move) for env, move in pairs], repeats, setup)
+  results["Environment.step[30x30]"]["positions"] = len(envs)
+  return results
+
+def bench_prepare_state(fx, repeats):
+  boards = fx["boards_30"]
+  result = timeit(lambda: [prepare_state(board) for board in boards], repeats)
+  result["positions"] = len(boards)
+  return {"prepare_state[30x30]": result}
+
+def bench_model(fx, model, repeats):
+  results = {}
+  boards = fx["boards_10"]
+  states = np.array([prepare_state(board) for board in boards], dtype=np.float32)
+  for batch_size in [1, 8, 64]:
+    batch = np.resize(states, (batch_size,) + states.shape[1:])
+    if batch_size == 1:
+      results["ZeroTTT.predict[b=1]"] = timeit(lambda: model.predict(batch[0]), repeats)
+    else:
+      results[f"ZeroTTT.predict[b={batch_size}]"] = timeit(lambda: model.predict(batch, interpret_output=False), repeats)
+    results[f"ZeroTTT.predict_batch[b={batch_size}]"] = timeit(lambda: model.predict_batch(batch), repeats)
+  return results
+
+def bench_mcts(fx, model, repeats):
+  results = {}
+  board = fx["boards_10"][0]
+  for num_simulations in [100, 400]:
+    args = dict(mcts_args, num_simulations=num_simulations)
+    def setup():
+      np.random.seed(80085)
+      return MCTS(model, board, args)
+    results[f"MCTS.search[sims={num_simulations}]"] = timeit(lambda mcts: mcts.search(), max(1, repeats // 4), setup)
+  return results
+
+def bench_database(fx, repeats):
+  results = {}
+  boards, policies = fx["boards_10"], fx["policies_10"]
+  db_args = {"max_len": 100000, "augmentations": ["flip", "rotate"]}
+
+  def setup():
+    return DataBase(db_args)
+  def append(db):
+    for board, policy in zip(boards, policies):
+      db.append_policy(board, policy)
+  results["DataBase.append_policy"] = timeit(append, repeats, setup)
+  results["DataBase.append_policy"]["positions"] = len(boards)
+
+  def filled_db():
+    db = DataBase(db_args)
+    while len(db.states) < 4096:
+      append(db)
+      db.append_value(1, len(boards))
+    return db
+  results["DataBase.prepare_batches[4096]"] = timeit(lambda db: db.prepare_batches(64), max(1, repeats // 4), filled_db)
+  return results
+
+def bench_evaluate_position(fx, repeats):
+  # behavioral_cloning pulls in pygame and tensorflow, skip it if those aren't installed
+  sys.path.insert(0, os.path.join(arena_path, "behavioral_cloning"))
+  try:
+    game_mechanics = importlib.import_module("game_mechanics")
+  except ImportError as e:
+    print(f"Skipping evaluate_position: {e}")
+    return {}
+  finally:
+    sys.path.pop(0)
+
+  # behavioral_cloning marks X with 2 and O with 1
+  boards = [np.where(board == 1, 2, np.where(board == -1, 1, 0)) for board in fx["boards_30"]]
+  result = timeit(lambda: [game_mechanics.evaluate_position(board) for board in boards], repeats)
+  result["positions"] = len(boards)
+  return {"game_mechanics.evaluate_position[30x30]": result}
+
+def current_commit():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=arena_path, text=True).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return "unknown"
+
+def compare(results, baseline_path):
+  with open(baseline_path) as f:
+    baseline = json.load(f)
+  print(f"Compared to {baseline['commit']}:")
+  for name, result in results["results"].items():
+    if name in baseline["results"]:
+      ratio = baseline["results"][name]["median_ms"] / result["median_ms"]
+      print(f"  {name}: {result['median_ms']:.3f} ms (x{ratio:.2f})")
+
+def get_arg_parser():
+  parser = argparse.ArgumentParser(description="Benchmark the engine hot paths")
+  parser.add_argument("--model_name", type=str, default="trained_model_3", help="Name of model stored in TTTArena/alphazero/models")
+  parser.add_argument("--repeats", type=int, default=20)
+  parser.add_argument("--out", type=str, default=None, help="Results file (default: benchmarks/results/<commit>.json)")
+  parser.add_argument("--compare", type=str, default=None, help="Results file of an earlier run to compare against")
+  return parser
+
+def main():
+  args = get_arg_parser().parse_args()
+  np.random.seed(80085)
+
+  fx = fixtures()
+  model = ZeroTTT(args.model_name, None)
+  model.brain.eval()
+
+  results = {}
+  results.update(bench_environment(fx, args.repeats))
+  results.update(bench_prepare_state(fx, args.repeats))
+  results.update(bench_model(fx, model, args.repeats))
+  results.update(bench_mcts(fx, model, args.repeats))
+  results.update(bench_database(fx, args.repeats))
+  results.update(bench_evaluate_position(fx, args.repeats))
+
+  for name, result in results.items():
+    print(f"{name}: {result['median_ms']:.3f} ms")
+
+  run = {
+    "commit": current_commit(),
+    "timestamp": time.time(),
+    "host": platform.node(),
+    "python": platform.python_version(),
+    "results": results
+  }
+
+  out = args.out if args.out is not None else os.path.join(arena_path, "benchmarks/results", f"{run['commit']}.json")
+  os.makedirs(os.path.dirname(out), exist_ok=True)
+  with open(out, "w") as f:
+    json.dump(run, f, indent=2)
+  print(f"Saved results to {out}")
+
+  if args.compare is not None:
+    compare(run, args.compare)
+
+if __name__ == "__main__":
+  main()
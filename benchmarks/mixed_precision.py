@@ -0,0 +1,113 @@
+# Training step time, final loss and inference throughput of ZeroTTT in float32, bf16 autocast and channels-last
+#
+# usage: python benchmarks/mixed_precision.py [--buffer_path replay_buffer] [--steps 200] [--batch_size 256] [--out results.json]
+#
+# Without a replay buffer the targets are the float32 predictions of the model on random positions, every mode starts
+# from the same weights and trains on the same batches so the final losses are comparable.
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+import torch
+
+sys.path.append(os.path.join(os.environ["HOME"], "TTTArena"))
+sys.path.append(os.path.join(os.environ["HOME"], "TTTArena", "alphazero")) # trainer imports its siblings directly
+
+from alphazero.model import ZeroTTT
+from alphazero.database import chunk_numbers
+from alphazero.quantization import load_calibration_states, random_calibration_states
+from trainer import Trainer
+
+modes = {
+  "float32": {},
+  "channels_last": {"channels_last": True},
+  "bf16": {"bf16": True},
+  "bf16+channels_last": {"bf16": True, "channels_last": True}
+}
+
+def load_dataset(args, model):
+  if args.buffer_path is not None:
+    states = load_calibration_states(args.buffer_path, max_positions=args.positions).astype(np.float64)
+    # Same chunks as load_calibration_states, in the same order
+    policies, values = [], []
+    for chunk_num in chunk_numbers(args.buffer_path):
+      policies.append(np.load(os.path.join(args.buffer_path, "policy_labels", f"policy_chunk_{chunk_num}.npy")))
+      values.append(np.load(os.path.join(args.buffer_path, "value_labels", f"value_chunk_{chunk_num}.npy")))
+      if sum(len(chunk) for chunk in policies) >= len(states):
+        break
+    return states, np.concatenate(policies)[:len(states)], np.concatenate(values)[:len(states)]
+
+  states = random_calibration_states(model.args["board_len"], args.positions)
+  policies, values = model.predict_batch(states)
+  return states.astype(np.float64), policies.reshape(len(states), -1).astype(np.float64), values.astype(np.float64)
+
+def time_training(model, trainer, states, policies, values, steps, batch_size):
+  # Seconds per train_step and the loss over the whole dataset afterwards
+  rng = np.random.default_rng(80085)
+  batches = [rng.choice(len(states), batch_size, replace=False) for _ in range(steps)]
+
+  model.brain.train()
+  trainer.train_step(states[batches[0]], policies[batches[0]], values[batches[0]]) # warm up
+  start = time.perf_counter()
+  for idx in batches[1:]:
+    trainer.train_step(states[idx], policies[idx], values[idx])
+  seconds = (time.perf_counter() - start) / (steps - 1)
+
+  model.brain.eval()
+  with torch.no_grad():
+    prob, val = model.predict(states, interpret_output=False)
+    loss = model.policy_loss(prob, torch.from_numpy(policies).to(model.device)) + \
+      model.value_loss(val.flatten(), torch.from_numpy(values).float().to(model.device))
+  return seconds, loss.item()
+
+def time_inference(model, states, batch_size, repeats=10):
+  batch = states[:batch_size].astype(np.float32)
+  model.predict_batch(batch)
+  start = time.perf_counter()
+  for _ in range(repeats):
+    model.predict_batch(batch)
+  return (time.perf_counter() - start) / repeats
+
+def get_arg_parser():
+  parser = argparse.ArgumentParser(description="Mixed precision and channels-last benchmark of ZeroTTT")
+  parser.add_argument("--model_name", type=str, default="trained_model_3", help="Name of model stored in TTTArena/alphazero/models")
+  parser.add_argument("--buffer_path", type=str, default=None, help="Replay buffer to train on (default: random positions)")
+  parser.add_argument("--positions", type=int, default=4096)
+  parser.add_argument("--steps", type=int, default=200)
+  parser.add_argument("--batch_size", type=int, default=256)
+  parser.add_argument("--out", type=str, default=None, help="JSON file to save the results to")
+  return parser
+
+def main():
+  args = get_arg_parser().parse_args()
+  base_args = {"board_len": 10, "lr": 3e-4, "weight_decay": 1e-4}
+
+  reference = ZeroTTT(args.model_name, None, base_args)
+  reference.brain.eval()
+  states, policies, values = load_dataset(args, reference)
+  trainer_args = {"mcts_args": {}, "db_args": {"max_len": 1, "augmentations": []}, "board_len": base_args["board_len"]}
+
+  results = []
+  for mode, mode_args in modes.items():
+    torch.manual_seed(80085)
+    model = ZeroTTT(args.model_name, None, dict(base_args, **mode_args))
+    trainer = Trainer(model, trainer_args)
+
+    model.brain.eval()
+    inference_seconds = time_inference(model, states, args.batch_size)
+    step_seconds, loss = time_training(model, trainer, states, policies, values, args.steps, args.batch_size)
+
+    results.append({"mode": mode, "step_ms": 1000 * step_seconds, "final_loss": loss, "inference_ms": 1000 * inference_seconds})
+    print(f"{mode}: {1000 * step_seconds:.1f} ms per training step, final loss {loss:.4f}, "
+      f"{1000 * inference_seconds:.1f} ms per predict_batch of {args.batch_size}")
+
+  if args.out is not None:
+    with open(args.out, "w") as f:
+      json.dump({"steps": args.steps, "batch_size": args.batch_size, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,65 @@
+# Scaling of root-parallel MCTS (alphazero/parallel.py) from 1 to N workers at a fixed simulation budget per move
+#
+# usage: python benchmarks/parallel_scaling.py [--max_workers N] [--num_simulations 800] [--out results.json]
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.environ["HOME"], "TTTArena"))
+
+from alphazero.mcts import MCTS
+from alphazero.model import ZeroTTT
+from alphazero.parallel import ParallelMCTS
+
+mcts_args = {
+  "alpha": 0.25,
+  "c_puct": 4,
+  "dirichlet_alpha": 0.3
+}
+
+def time_moves(mcts, moves):
+  # Seconds per searched move, the searched move is played so later searches reuse the tree
+  start = time.perf_counter()
+  for _ in range(moves):
+    mcts.search()
+    mcts.select_move(tau=0.01)
+  return (time.perf_counter() - start) / moves
+
+def get_arg_parser():
+  parser = argparse.ArgumentParser(description="Scaling benchmark of root-parallel MCTS")
+  parser.add_argument("--model_name", type=str, default="trained_model_3", help="Name of model stored in TTTArena/alphazero/models")
+  parser.add_argument("--max_workers", type=int, default=len(os.sched_getaffinity(0)))
+  parser.add_argument("--num_simulations", type=int, default=800)
+  parser.add_argument("--moves", type=int, default=4)
+  parser.add_argument("--out", type=str, default=None, help="JSON file to save the results to")
+  return parser
+
+def main():
+  args = get_arg_parser().parse_args()
+  model = ZeroTTT(args.model_name, None)
+  model.brain.eval()
+  board = np.zeros((model.args["board_len"], model.args["board_len"]))
+
+  results = []
+  for num_workers in range(1, args.max_workers + 1):
+    np.random.seed(80085)
+    search_args = dict(mcts_args, num_simulations=args.num_simulations, num_workers=num_workers)
+    mcts = ParallelMCTS(model, board, search_args) if num_workers > 1 else MCTS(model, board, search_args)
+    seconds = time_moves(mcts, args.moves)
+    if num_workers > 1:
+      mcts.close()
+
+    results.append({"workers": num_workers, "seconds_per_move": seconds, "simulations_per_sec": args.num_simulations / seconds})
+    print(f"{num_workers} workers: {1000 * seconds:.1f} ms per move, {args.num_simulations / seconds:.1f} simulations/sec, "
+      f"x{results[0]['seconds_per_move'] / seconds:.2f}")
+
+  if args.out is not None:
+    with open(args.out, "w") as f:
+      json.dump({"num_simulations": args.num_simulations, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+  main()
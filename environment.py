@@ -1,5 +1,7 @@
 import numpy as np
 
+five_windows_cache = {}
+
 class Environment():
   def __init__(self, board_len=30):
 
@@ -52,11 +54,28 @@ class Environment():
         elif similarity ==  -5 or similarity_t == -5:
           return -1
     
-    if np.any(board == 0) is False: # draw
+    if not np.any(board == 0): # draw
       return 0
 
     return 10
 
+  @staticmethod
+  def five_windows(board_len):
+    # Flat board indices of every line of 5 cells (rows, columns and both diagonals), shape: # of lines x 5
+    if board_len not in five_windows_cache:
+      cells = np.arange(board_len*board_len).reshape(board_len, board_len)
+      windows = []
+      for i in range(board_len):
+        for j in range(board_len - 4):
+          windows.append(cells[i, j : j + 5])
+          windows.append(cells[j : j + 5, i])
+      for i in range(board_len - 4):
+        for j in range(board_len - 4):
+          windows.append(np.diagonal(cells[i : i + 5, j : j + 5]))
+          windows.append(np.diagonal(np.fliplr(cells[i : i + 5, j : j + 5])))
+      five_windows_cache[board_len] = np.array(windows)
+    return five_windows_cache[board_len]
+
   def render(self):
     show_board = np.full((self.board_len, self.board_len), ' ')
     for i, action in enumerate(self.move_hist):